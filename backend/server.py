@@ -1,21 +1,33 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Request, BackgroundTasks, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError, PyMongoError
+from bson import ObjectId, Int64
+from gridfs.errors import NoFile
 import os
+import re
+import time
+import unicodedata
+import asyncio
 import logging
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, AsyncIterator
 import uuid
+from urllib.parse import quote
 from datetime import datetime, timezone, date, timedelta
 import jwt
 import bcrypt
 from enum import Enum
 import base64
+import hashlib
 import io
+import json
 import zipfile
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -23,6 +35,7 @@ from reportlab.lib.units import cm
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image as RLImage
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
+from PIL import Image as PILImage, ImageOps
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -32,6 +45,9 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Photo and attachment bytes live in GridFS, documents keep only a reference
+fs = AsyncIOMotorGridFSBucket(db, bucket_name="blobs")
+
 # JWT Settings
 JWT_SECRET = os.environ.get('JWT_SECRET', 'ambulatorio-infermieristico-secret-key-2024')
 JWT_ALGORITHM = "HS256"
@@ -155,6 +171,35 @@ class AppointmentCreate(BaseModel):
     prestazioni: List[str]
     note: Optional[str] = None
 
+class AppointmentSeriesCreate(BaseModel):
+    patient_id: str
+    ambulatorio: Ambulatorio
+    data_inizio: str  # YYYY-MM-DD
+    ora: str
+    tipo: str
+    prestazioni: List[str]
+    note: Optional[str] = None
+    ogni_giorni: int = 7  # 7 = settimanale
+    fino_a: Optional[str] = None  # YYYY-MM-DD, inclusive
+    occorrenze: Optional[int] = None
+
+class AppointmentReschedule(BaseModel):
+    ambulatorio: Ambulatorio
+    data: str  # day to empty
+    tipo: Optional[str] = None
+    ora: Optional[str] = None
+    appointment_ids: Optional[List[str]] = None  # subset of the day, default all
+    date_destinazione: List[str]  # target days, in order of preference
+    solo_stessa_ora: bool = False  # otherwise fall back to any free slot of the target day
+
+class AppointmentBulkComplete(BaseModel):
+    ambulatorio: Ambulatorio
+    appointment_ids: Optional[List[str]] = None
+    data: Optional[str] = None  # whole day, or a slot together with ora
+    ora: Optional[str] = None
+    tipo: Optional[str] = None
+    completed: bool = True
+
 class Appointment(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -260,6 +305,14 @@ class SchedaGestionePICCCreate(BaseModel):
     giorni: Dict[str, Dict[str, Any]] = {}  # {1: {lavaggio_mani: true, ...}, 2: {...}}
     note: Optional[str] = None
 
+class GestioneCellUpdate(BaseModel):
+    giorno: str  # key of the day in giorni
+    campo: Optional[str] = None  # None = the whole day
+    valore: Any = None  # None removes the cell (or the day)
+
+class GestioneGiorniPatch(BaseModel):
+    modifiche: List[GestioneCellUpdate]
+
 class SchedaGestionePICC(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -290,7 +343,12 @@ class Photo(BaseModel):
     tipo: str
     descrizione: Optional[str] = None
     data: str
-    image_data: str  # Base64
+    image_data: Optional[str] = None  # Base64, only for legacy documents stored inline
+    blob_id: Optional[str] = None  # GridFS file id
+    size: Optional[int] = None
+    sha256: Optional[str] = None
+    thumbnails: Dict[str, Dict[str, Any]] = {}  # {"160": {blob_id, size, sha256}, ...}
+    thumbnail_error: Optional[str] = None  # set when the image cannot be decoded, so it is not retried
     file_type: Optional[str] = "image"  # image, pdf, word, excel
     original_name: Optional[str] = None
     mime_type: Optional[str] = None
@@ -404,6 +462,48 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security))
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Token non valido")
 
+async def update_with_access(collection, doc_id: str, update: dict, payload: dict, not_found: str,
+                             return_document: ReturnDocument = ReturnDocument.AFTER,
+                             projection: Optional[Dict[str, Any]] = None) -> dict:
+    """Update a document in a single round trip: the ambulatorio access check is part
+    of the filter. Only a failed update pays a second query to choose 404 or 403"""
+    result = await collection.find_one_and_update(
+        {"id": doc_id, "ambulatorio": {"$in": payload["ambulatori"]}},
+        update,
+        projection=projection or {"_id": 0},
+        return_document=return_document
+    )
+    if result is None:
+        if await collection.count_documents({"id": doc_id}, limit=1):
+            raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+        raise HTTPException(status_code=404, detail=not_found)
+    return result
+
+# Sparse list responses: view=summary or fields=a,b selects the columns. The projection runs
+# in MongoDB and the documents are sent as they are, without the response_model round trip.
+SUMMARY_FIELDS = {
+    Patient: ("nome", "cognome", "tipo", "status", "data_nascita", "codice_fiscale"),
+    Appointment: ("patient_id", "patient_nome", "patient_cognome", "data", "ora", "tipo", "completed"),
+    SchedaMedicazioneMED: ("patient_id", "data_compilazione", "prossimo_cambio"),
+    SchedaImpiantoPICC: ("patient_id", "data_impianto", "tipo_catetere", "sede"),
+    SchedaGestionePICC: ("patient_id", "mese", "updated_at"),
+}
+
+def list_projection(model, fields: Optional[str], view: Optional[str]) -> Optional[Dict[str, int]]:
+    """Projection for a list endpoint, or None for the full documents"""
+    if fields:
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        unknown = set(names) - set(model.model_fields)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Campi non validi: {', '.join(sorted(unknown))}")
+    elif view == "summary":
+        names = SUMMARY_FIELDS[model]
+    elif view in (None, "full"):
+        return None
+    else:
+        raise HTTPException(status_code=400, detail=f"Vista non valida: {view}")
+    return {"_id": 0, "id": 1, **{name: 1 for name in names}}
+
 # ============== AUTH ROUTES ==============
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(data: UserLogin):
@@ -433,6 +533,308 @@ async def get_current_user(payload: dict = Depends(verify_token)):
         ambulatori=user["ambulatori"]
     )
 
+# ============== PATIENT SEARCH ==============
+# Patients carry search_tokens: lower-case, accent-free words of nome and cognome (plus
+# each name written as one word, "Di Stefano" -> "distefano") and the codice fiscale.
+# Searches are anchored prefix regexes on that multikey field, which use the index.
+SEARCH_FIELDS = ("nome", "cognome", "codice_fiscale")
+CODICE_FISCALE_RE = re.compile(r"^[a-z]{6}[0-9a-z]{10}$")
+
+def normalize_text(value: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", value.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def text_words(value: Optional[str]) -> List[str]:
+    return re.findall(r"[a-z0-9]+", normalize_text(value or ""))
+
+def patient_search_tokens(patient: dict) -> List[str]:
+    tokens = set()
+    for field in ("nome", "cognome"):
+        words = text_words(patient.get(field))
+        tokens.update(words)
+        if len(words) > 1:
+            tokens.add("".join(words))
+    codice_fiscale = "".join(text_words(patient.get("codice_fiscale")))
+    if codice_fiscale:
+        tokens.add(codice_fiscale)
+    return sorted(tokens)
+
+def patient_search_query(search: str) -> Dict[str, Any]:
+    """Every word of the search must be the prefix of a token; a codice fiscale matches exactly"""
+    words = text_words(search)
+    if len(words) == 1 and CODICE_FISCALE_RE.match(words[0]):
+        return {"search_tokens": words[0]}
+    if not words:
+        return {}
+    return {"$and": [{"search_tokens": {"$regex": f"^{re.escape(word)}"}} for word in words]}
+
+# Fuzzy search: patient_trigrams holds one posting per (trigram, patient, campo) of nome and
+# cognome, with n = the field's trigram count, so similarity is computed from postings alone.
+# The score is the share of the query trigrams found in the patient's names (containment),
+# so typing only the surname is not diluted by the first name; ties go to the closest field.
+FUZZY_NAME_FIELDS = ("nome", "cognome")
+FUZZY_MIN_SCORE = 0.5
+FUZZY_CANDIDATES = 200
+
+def word_trigrams(words: List[str]) -> set:
+    grams = set()
+    for word in words:
+        padded = f"$${word}$"
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def name_trigrams(text: Optional[str]) -> set:
+    # The whole text as one word, so "Di Stefano" and "Distefano" share every trigram.
+    # Used for both the stored names and the query, which must be tokenized alike
+    name = "".join(text_words(text))
+    return word_trigrams([name]) if name else set()
+
+def patient_trigrams(patient: dict) -> Dict[str, List[str]]:
+    return {field: sorted(name_trigrams(patient.get(field))) for field in FUZZY_NAME_FIELDS}
+
+def fuzzy_score(query_count: int, hits: int, fields: List[Dict[str, int]]) -> Tuple[float, float]:
+    """(containment, best field Jaccard) of a patient, from the distinct query trigrams found in
+    all its names (hits) and, per field, the ones found in that field and its trigram count n"""
+    containment = hits / query_count
+    jaccard = max((f["hits"] / (f["n"] + query_count - f["hits"]) for f in fields), default=0.0)
+    return containment, jaccard
+
+async def index_patient_trigrams(patient: dict):
+    await db.patient_trigrams.delete_many({"patient_id": patient["id"]})
+    postings = [
+        {"trigram": gram, "ambulatorio": enum_value(patient["ambulatorio"]), "campo": field,
+         "patient_id": patient["id"], "n": len(grams)}
+        for field, grams in patient_trigrams(patient).items() for gram in grams
+    ]
+    if not postings:
+        return
+    try:
+        await db.patient_trigrams.insert_many(postings, ordered=False)
+    except BulkWriteError as e:
+        # A concurrent reindex of the same patient already wrote these postings
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+
+SEARCH_SOURCE_PROJECTION = {"_id": 0, "id": 1, "ambulatorio": 1, "nome": 1, "cognome": 1, "codice_fiscale": 1}
+
+async def index_patient_search(patient: dict):
+    await db.patients.update_one({"id": patient["id"]}, {"$set": {"search_tokens": patient_search_tokens(patient)}})
+    await index_patient_trigrams(patient)
+
+async def rebuild_patient_search():
+    """Recompute search_tokens and trigram postings for every patient"""
+    updated = 0
+    # Dropped rather than emptied: postings of older layouts may block the unique index
+    await db.patient_trigrams.drop()
+    await ensure_indexes(["patient_trigrams"])
+    async for patient in db.patients.find({}, SEARCH_SOURCE_PROJECTION):
+        await index_patient_search(patient)
+        updated += 1
+    logger.info(f"Indice di ricerca pazienti ricostruito: {updated} pazienti")
+    return updated
+
+async def backfill_patient_search():
+    """Index only the patients missing from search: no search_tokens, no trigram postings, or
+    postings of the layout without campo. The values written depend only on the patient, so
+    several workers running it at startup at the same time converge on the same state"""
+    indexed = set(await db.patient_trigrams.distinct("patient_id", {"campo": {"$exists": True}}))
+    stale = set(await db.patient_trigrams.distinct("patient_id", {"campo": {"$exists": False}}))
+    filled = 0
+    async for patient in db.patients.find({}, {**SEARCH_SOURCE_PROJECTION, "search_tokens": 1}):
+        if "search_tokens" in patient and patient["id"] in indexed and patient["id"] not in stale:
+            continue
+        await index_patient_search(patient)
+        filled += 1
+    if filled:
+        # The unique index on postings could not be built while old-layout duplicates existed
+        await db.patient_trigrams.delete_many({"campo": {"$exists": False}})
+        await ensure_indexes(["patient_trigrams"])
+        logger.info(f"Indice di ricerca pazienti completato: {filled} pazienti")
+    return filled
+
+# ============== FULL-TEXT SEARCH ==============
+# One Italian-stemmed text index per collection, prefixed by ambulatorio so each
+# query is a single indexed lookup. language_override points at a field no document has,
+# otherwise a "language" key in user data would change the stemmer.
+TEXT_SEARCH_SOURCES = [
+    # (collection, fonte, text fields, patient id field, date field)
+    ("patients", "paziente", ("anamnesi", "terapia_in_atto", "allergie"), "id", None),
+    ("schede_medicazione_med", "scheda_medicazione_med", ("medicazione",), "patient_id", "data_compilazione"),
+    ("schede_impianto_picc", "scheda_impianto_picc", ("note",), "patient_id", "data_impianto"),
+    ("schede_gestione_picc", "scheda_gestione_picc", ("note",), "patient_id", "mese"),
+]
+TEXT_INDEX_OPTIONS = {"default_language": "italian", "language_override": "lingua_indice_testo"}
+SNIPPET_RADIUS = 60
+
+def fold_text(text: str) -> str:
+    """Lower-case, accent-free copy of text with the same length, so offsets map back"""
+    return "".join((normalize_text(c) or c)[0] for c in text)
+
+def text_snippet(text: str, words: List[str]) -> Optional[Dict[str, Any]]:
+    """Window of text around the first match, with [start, end) offsets of every match in it.
+    Matching is on word prefixes, a rough stand-in for the server-side stemming"""
+    stems = [w[:max(4, len(w) - 2)] for w in words]
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(stem) for stem in stems) + r")\w*")
+    matches = list(pattern.finditer(fold_text(text)))
+    if not matches:
+        return None
+    start = max(matches[0].start() - SNIPPET_RADIUS, 0)
+    end = min(matches[0].end() + SNIPPET_RADIUS, len(text))
+    return {
+        "snippet": ("…" if start else "") + text[start:end] + ("…" if end < len(text) else ""),
+        "evidenziazioni": [
+            [m.start() - start + (1 if start else 0), min(m.end(), end) - start + (1 if start else 0)]
+            for m in matches if m.start() < end and m.start() >= start
+        ],
+    }
+
+async def text_search_source(source: tuple, ambulatorio: str, q: str, words: List[str], limit: int) -> List[Dict[str, Any]]:
+    collection, fonte, fields, patient_field, date_field = source
+    projection = {"_id": 0, "id": 1, patient_field: 1, "score": {"$meta": "textScore"}}
+    projection.update({field: 1 for field in fields})
+    if date_field:
+        projection[date_field] = 1
+    docs = await db[collection].find(
+        {"ambulatorio": ambulatorio, "$text": {"$search": q}}, projection
+    ).sort([("score", {"$meta": "textScore"})]).limit(limit).to_list(limit)
+    
+    hits = []
+    for doc in docs:
+        for field in fields:
+            snippet = text_snippet(doc.get(field) or "", words)
+            if snippet:
+                hits.append({
+                    "patient_id": doc[patient_field],
+                    "fonte": fonte,
+                    "id": doc["id"],
+                    "campo": field,
+                    "data": doc.get(date_field) if date_field else None,
+                    "score": doc["score"],
+                    **snippet
+                })
+        # Stemmed match with no literal prefix to highlight: still report the document
+        if not any(hit["id"] == doc["id"] for hit in hits):
+            hits.append({
+                "patient_id": doc[patient_field], "fonte": fonte, "id": doc["id"], "campo": None,
+                "data": doc.get(date_field) if date_field else None, "score": doc["score"],
+                "snippet": None, "evidenziazioni": []
+            })
+    return hits
+
+@api_router.get("/search/text")
+async def full_text_search(
+    ambulatorio: Ambulatorio,
+    q: str,
+    limit: int = Query(50, ge=1, le=200),
+    payload: dict = Depends(verify_token)
+):
+    """Full-text search over anamnesi, terapia, allergie and the notes of every scheda.
+    The four collections are queried concurrently; hits are grouped by patient and ranked"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    words = text_words(q)
+    if not words:
+        return []
+    
+    results = await asyncio.gather(*[
+        text_search_source(source, ambulatorio.value, q, words, limit) for source in TEXT_SEARCH_SOURCES
+    ])
+    by_patient: Dict[str, Dict[str, Any]] = {}
+    scored = set()
+    for hit in (hit for hits in results for hit in hits):
+        group = by_patient.setdefault(hit["patient_id"], {"patient_id": hit["patient_id"], "score": 0, "risultati": []})
+        # A document matching in several fields yields several hits but counts once
+        score = hit.pop("score")
+        if (hit["fonte"], hit["id"]) not in scored:
+            scored.add((hit["fonte"], hit["id"]))
+            group["score"] += score
+        group["risultati"].append(hit)
+    
+    patients = await db.patients.find(
+        {"id": {"$in": list(by_patient)}}, {"_id": 0, "id": 1, "nome": 1, "cognome": 1, "tipo": 1, "status": 1}
+    ).to_list(None)
+    ranked = []
+    for patient in patients:
+        group = by_patient[patient["id"]]
+        group["patient"] = patient
+        group["score"] = round(group["score"], 3)
+        ranked.append(group)
+    # Schede of deleted patients are dropped with the missing patient
+    return sorted(ranked, key=lambda g: -g["score"])[:limit]
+
+# ============== GLOBAL SEARCH ==============
+# Header typeahead: patients by name prefix, upcoming appointments and schede notes, queried
+# concurrently. Recent queries are cached briefly, since typing re-sends the same prefixes.
+GLOBAL_SEARCH_CACHE_TTL = 10  # seconds
+GLOBAL_SEARCH_CACHE_MAX = 500
+_global_search_cache: Dict[Tuple[str, str, int], Tuple[float, Dict[str, List[Dict[str, Any]]]]] = {}
+
+def invalidate_global_search(ambulatorio: str):
+    for key in [key for key in _global_search_cache if key[0] == ambulatorio]:
+        del _global_search_cache[key]
+
+UPCOMING_SEARCH_PATIENTS = 200
+
+async def search_upcoming_appointments(ambulatorio: str, q: str, limit: int) -> List[Dict[str, Any]]:
+    # Names are matched through search_tokens like the patient list, so accents and apostrophes
+    # behave the same; the appointments are then read by patient_id on the (ambulatorio, data) index.
+    patients = await db.patients.find(
+        {"ambulatorio": ambulatorio, **patient_search_query(q)}, {"_id": 0, "id": 1}
+    ).limit(UPCOMING_SEARCH_PATIENTS).to_list(UPCOMING_SEARCH_PATIENTS)
+    if not patients:
+        return []
+    query = {
+        "ambulatorio": ambulatorio,
+        "data": {"$gte": datetime.now().strftime("%Y-%m-%d")},
+        "patient_id": {"$in": [p["id"] for p in patients]},
+    }
+    return await db.appointments.find(
+        query, {"_id": 0, "id": 1, "patient_id": 1, "patient_nome": 1, "patient_cognome": 1, "data": 1, "ora": 1, "tipo": 1}
+    ).sort([("data", 1), ("ora", 1)]).limit(limit).to_list(limit)
+
+async def search_schede(ambulatorio: str, q: str, words: List[str], limit: int) -> List[Dict[str, Any]]:
+    results = await asyncio.gather(*[
+        text_search_source(source, ambulatorio, q, words, limit)
+        for source in TEXT_SEARCH_SOURCES if source[1] != "paziente"
+    ])
+    hits = sorted((hit for hits in results for hit in hits), key=lambda hit: -hit["score"])
+    return hits[:limit]
+
+@api_router.get("/search")
+async def global_search(
+    ambulatorio: Ambulatorio,
+    q: str,
+    limit: int = Query(5, ge=1, le=20),
+    payload: dict = Depends(verify_token)
+):
+    """Top results per type for the header search: pazienti, appuntamenti (from today) and schede"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    words = text_words(q)
+    if not words:
+        return {"pazienti": [], "appuntamenti": [], "schede": []}
+    
+    key = (ambulatorio.value, " ".join(words), limit)
+    now = time.monotonic()
+    cached = _global_search_cache.get(key)
+    if cached and now - cached[0] < GLOBAL_SEARCH_CACHE_TTL:
+        return cached[1]
+    
+    patient_query = {"ambulatorio": ambulatorio.value, **patient_search_query(q)}
+    pazienti, appuntamenti, schede = await asyncio.gather(
+        db.patients.find(
+            patient_query, {"_id": 0, "id": 1, "nome": 1, "cognome": 1, "tipo": 1, "status": 1, "codice_fiscale": 1}
+        ).sort("cognome", 1).limit(limit).to_list(limit),
+        search_upcoming_appointments(ambulatorio.value, q, limit),
+        search_schede(ambulatorio.value, q, words, limit),
+    )
+    result = {"pazienti": pazienti, "appuntamenti": appuntamenti, "schede": schede}
+    
+    if len(_global_search_cache) >= GLOBAL_SEARCH_CACHE_MAX:
+        _global_search_cache.clear()
+    _global_search_cache[key] = (now, result)
+    return result
+
 # ============== PATIENTS ROUTES ==============
 @api_router.post("/patients", response_model=Patient, status_code=201)
 async def create_patient(data: PatientCreate, payload: dict = Depends(verify_token)):
@@ -446,7 +848,11 @@ async def create_patient(data: PatientCreate, payload: dict = Depends(verify_tok
     
     patient = Patient(**data.model_dump())
     doc = patient.model_dump()
+    doc["search_tokens"] = patient_search_tokens(doc)
     await db.patients.insert_one(doc)
+    await index_patient_trigrams(doc)
+    invalidate_global_search(doc["ambulatorio"])
+    invalidate_patient_summary(doc["ambulatorio"])
     return patient
 
 @api_router.get("/patients", response_model=List[Patient])
@@ -455,6 +861,8 @@ async def get_patients(
     status: Optional[PatientStatus] = None,
     tipo: Optional[PatientType] = None,
     search: Optional[str] = None,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
     payload: dict = Depends(verify_token)
 ):
     if ambulatorio.value not in payload["ambulatori"]:
@@ -466,14 +874,96 @@ async def get_patients(
     if tipo:
         query["tipo"] = tipo.value
     if search:
-        query["$or"] = [
-            {"nome": {"$regex": search, "$options": "i"}},
-            {"cognome": {"$regex": search, "$options": "i"}}
-        ]
+        query.update(patient_search_query(search))
     
-    patients = await db.patients.find(query, {"_id": 0}).sort("cognome", 1).to_list(1000)
+    projection = list_projection(Patient, fields, view)
+    patients = await db.patients.find(query, projection or {"_id": 0, "search_tokens": 0}).sort("cognome", 1).to_list(1000)
+    if projection:
+        return JSONResponse(patients)
     return patients
 
+# Dashboard counters per ambulatorio. Patient writes in this process drop the entry;
+# the TTL bounds staleness from other workers.
+PATIENT_SUMMARY_TTL = 60  # seconds
+_patient_summary_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+def invalidate_patient_summary(ambulatorio: str):
+    _patient_summary_cache.pop(ambulatorio, None)
+
+@api_router.get("/patients/summary")
+async def get_patients_summary(ambulatorio: Ambulatorio, payload: dict = Depends(verify_token)):
+    """Patient counts per status, per tipo and per (status, tipo) from a single $group"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    now = time.monotonic()
+    cached = _patient_summary_cache.get(ambulatorio.value)
+    if cached and now - cached[0] < PATIENT_SUMMARY_TTL:
+        return cached[1]
+    
+    rows = await db.patients.aggregate([
+        {"$match": {"ambulatorio": ambulatorio.value}},
+        {"$group": {"_id": {"status": "$status", "tipo": "$tipo"}, "count": {"$sum": 1}}},
+    ]).to_list(None)
+    per_status = {status.value: 0 for status in PatientStatus}
+    per_tipo = {tipo.value: 0 for tipo in PatientType}
+    per_status_tipo = {status: {tipo: 0 for tipo in per_tipo} for status in per_status}
+    for row in rows:
+        status, tipo = row["_id"].get("status"), row["_id"].get("tipo")
+        per_status[status] = per_status.get(status, 0) + row["count"]
+        per_tipo[tipo] = per_tipo.get(tipo, 0) + row["count"]
+        per_status_tipo.setdefault(status, {})[tipo] = per_status_tipo.get(status, {}).get(tipo, 0) + row["count"]
+    summary = {
+        "totale": sum(row["count"] for row in rows),
+        "per_status": per_status,
+        "per_tipo": per_tipo,
+        "per_status_tipo": per_status_tipo,
+    }
+    _patient_summary_cache[ambulatorio.value] = (now, summary)
+    return summary
+
+@api_router.get("/patients/search/fuzzy")
+async def fuzzy_search_patients(
+    ambulatorio: Ambulatorio,
+    q: str,
+    limit: int = Query(20, ge=1, le=100),
+    payload: dict = Depends(verify_token)
+):
+    """Ranked close matches on nome/cognome, tolerant to typos and spacing ("Di Stefano" ~ "Distefano").
+    Score is the share of the query trigrams found in the patient's names"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    grams = sorted(name_trigrams(q))
+    if not grams:
+        return []
+    # Distinct trigrams ($addToSet) per field, then their union per patient
+    pipeline = [
+        {"$match": {"ambulatorio": ambulatorio.value, "trigram": {"$in": grams}}},
+        {"$group": {"_id": {"patient_id": "$patient_id", "campo": "$campo"}, "grams": {"$addToSet": "$trigram"}, "n": {"$first": "$n"}}},
+        {"$group": {"_id": "$_id.patient_id", "fields": {"$push": {"hits": {"$size": "$grams"}, "n": "$n"}}, "grams": {"$push": "$grams"}}},
+        {"$project": {"fields": 1, "hits": {"$size": {"$reduce": {
+            "input": "$grams", "initialValue": [], "in": {"$setUnion": ["$$value", "$$this"]}
+        }}}}},
+        {"$match": {"hits": {"$gte": FUZZY_MIN_SCORE * len(grams)}}},
+        {"$sort": {"hits": -1}},
+        {"$limit": FUZZY_CANDIDATES},
+    ]
+    rows = await db.patient_trigrams.aggregate(pipeline).to_list(FUZZY_CANDIDATES)
+    scores = dict(sorted(
+        ((row["_id"], fuzzy_score(len(grams), row["hits"], row["fields"])) for row in rows),
+        key=lambda item: item[1], reverse=True
+    )[:limit])
+    patients = await db.patients.find(
+        {"id": {"$in": list(scores)}},
+        {"_id": 0, "id": 1, "nome": 1, "cognome": 1, "tipo": 1, "status": 1, "data_nascita": 1, "codice_fiscale": 1}
+    ).to_list(limit)
+    for patient in patients:
+        containment, jaccard = scores[patient["id"]]
+        patient["score"] = round(containment, 3)
+        patient["similarita_campo"] = round(jaccard, 3)
+    return sorted(patients, key=lambda p: (-p["score"], -p["similarita_campo"], p["cognome"]))
+
 @api_router.get("/patients/{patient_id}", response_model=Patient)
 async def get_patient(patient_id: str, payload: dict = Depends(verify_token)):
     patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
@@ -483,19 +973,80 @@ async def get_patient(patient_id: str, payload: dict = Depends(verify_token)):
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     return patient
 
-@api_router.put("/patients/{patient_id}", response_model=Patient)
-async def update_patient(patient_id: str, data: PatientUpdate, payload: dict = Depends(verify_token)):
-    patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
-    if not patient:
-        raise HTTPException(status_code=404, detail="Paziente non trovato")
-    if patient["ambulatorio"] not in payload["ambulatori"]:
+BUNDLE_SECTIONS = ("patient", "schede_medicazione_med", "schede_impianto_picc", "schede_gestione_picc", "photos")
+BUNDLE_PHOTOS_LIMIT = 50
+
+@api_router.get("/patients/{patient_id}/bundle")
+async def get_patient_bundle(
+    patient_id: str,
+    ambulatorio: Ambulatorio,
+    sections: Optional[str] = None,
+    payload: dict = Depends(verify_token)
+):
+    """Patient chart in one round trip: the requested sections (comma-separated, default all)
+    are queried concurrently. Photos are metadata only, first page with next_cursor"""
+    if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    requested = BUNDLE_SECTIONS if not sections else tuple(name.strip() for name in sections.split(",") if name.strip())
+    unknown = set(requested) - set(BUNDLE_SECTIONS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Sezioni non valide: {', '.join(sorted(unknown))}")
     
+    query = {"patient_id": patient_id, "ambulatorio": ambulatorio.value}
+    # The patient is always read: it is the existence check for the other sections
+    patient_projection = {"_id": 0, "search_tokens": 0} if "patient" in requested else {"_id": 0, "id": 1}
+    photo_projection = {field: 1 for field in PHOTO_METADATA_FIELDS}
+    photo_projection["_id"] = 0
+    # Built lazily: only the requested sections start a query
+    queries = {
+        "patient": lambda: db.patients.find_one({"id": patient_id, "ambulatorio": ambulatorio.value}, patient_projection),
+        "schede_medicazione_med": lambda: db.schede_medicazione_med.find(query, {"_id": 0}).sort("data_compilazione", -1).to_list(1000),
+        "schede_impianto_picc": lambda: db.schede_impianto_picc.find(query, {"_id": 0}).sort("data_impianto", -1).to_list(1000),
+        "schede_gestione_picc": lambda: db.schede_gestione_picc.find(query, {"_id": 0}).sort("mese", -1).to_list(100),
+        "photos": lambda: db.photos.find(query, photo_projection).sort(
+            [("data", -1), ("id", -1)]
+        ).limit(BUNDLE_PHOTOS_LIMIT + 1).to_list(BUNDLE_PHOTOS_LIMIT + 1),
+    }
+    names = ["patient"] + [name for name in dict.fromkeys(requested) if name != "patient"]
+    results = dict(zip(names, await asyncio.gather(*[queries[name]() for name in names])))
+    if not results["patient"]:
+        raise HTTPException(status_code=404, detail="Paziente non trovato")
+    
+    bundle = {}
+    if "patient" in requested:
+        bundle["patient"] = results["patient"]
+    for name in ("schede_medicazione_med", "schede_impianto_picc"):
+        if name in requested:
+            bundle[name] = results[name]
+    if "schede_gestione_picc" in requested:
+        bundle["schede_gestione_picc"] = [decode_scheda_gestione(scheda) for scheda in results["schede_gestione_picc"]]
+    if "photos" in requested:
+        photos = results["photos"]
+        next_cursor = None
+        if len(photos) > BUNDLE_PHOTOS_LIMIT:
+            photos = photos[:BUNDLE_PHOTOS_LIMIT]
+            next_cursor = encode_cursor({"data": photos[-1]["data"], "id": photos[-1]["id"]})
+        bundle["photos"] = {"items": [photo_urls(photo) for photo in photos], "next_cursor": next_cursor}
+    return bundle
+
+@api_router.put("/patients/{patient_id}", response_model=Patient)
+async def update_patient(patient_id: str, data: PatientUpdate, payload: dict = Depends(verify_token)):
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
     
-    await db.patients.update_one({"id": patient_id}, {"$set": update_data})
-    updated = await db.patients.find_one({"id": patient_id}, {"_id": 0})
+    if set(SEARCH_FIELDS) & update_data.keys():
+        # Tokens depend on all the name fields: fill in the ones not being changed
+        current = {}
+        if not set(SEARCH_FIELDS) <= update_data.keys():
+            current = await db.patients.find_one({"id": patient_id}, {"_id": 0, **{f: 1 for f in SEARCH_FIELDS}}) or {}
+        update_data["search_tokens"] = patient_search_tokens({**current, **update_data})
+    
+    updated = await update_with_access(db.patients, patient_id, {"$set": update_data}, payload, "Paziente non trovato")
+    if {"nome", "cognome"} & update_data.keys():
+        await index_patient_trigrams(updated)
+        invalidate_global_search(updated["ambulatorio"])
+    if {"status", "tipo"} & update_data.keys():
+        invalidate_patient_summary(updated["ambulatorio"])
     return updated
 
 @api_router.delete("/patients/{patient_id}")
@@ -508,17 +1059,155 @@ async def delete_patient(patient_id: str, payload: dict = Depends(verify_token))
     
     # Delete patient
     await db.patients.delete_one({"id": patient_id})
+    await db.patient_trigrams.delete_many({"patient_id": patient_id})
+    invalidate_global_search(patient["ambulatorio"])
+    invalidate_patient_summary(patient["ambulatorio"])
     
     # Delete all related records
     await db.schede_impianto_picc.delete_many({"patient_id": patient_id})
     await db.schede_gestione_picc.delete_many({"patient_id": patient_id})
     await db.schede_medicazione_med.delete_many({"patient_id": patient_id})
+    appointments = await db.appointments.find({"patient_id": patient_id}, ROLLUP_PROJECTION).to_list(None)
     await db.appointments.delete_many({"patient_id": patient_id})
+    await release_slots(appointments)
+    await apply_stats_rollup(appointments, -1)
     await db.prescrizioni.delete_many({"patient_id": patient_id})
+    photos = await db.photos.find(
+        {"patient_id": patient_id}, {"_id": 0, "blob_id": 1, "thumbnails": 1}
+    ).to_list(None)
     await db.photos.delete_many({"patient_id": patient_id})
+    for photo in photos:
+        for blob_id in photo_blob_ids(photo):
+            await delete_blob(blob_id)
     
     return {"message": "Paziente e tutte le schede correlate eliminati"}
 
+# ============== SLOT OCCUPANCY ==============
+# slot_occupancy holds one counter per (ambulatorio, data, ora, tipo). Reserving is a
+# conditional $inc guarded by capacity; the unique index turns a full slot into a
+# DuplicateKeyError on the upsert instead of a second document.
+SLOT_CAPACITY = 2
+SLOT_FIELDS = ("ambulatorio", "data", "ora", "tipo")
+
+def slot_key(appointment: dict) -> Dict[str, str]:
+    return {field: enum_value(appointment[field]) for field in SLOT_FIELDS}
+
+async def reserve_slot(key: Dict[str, str]) -> bool:
+    """Atomically take one place in a slot; False when the slot is full"""
+    guarded = {**key, "booked": {"$lt": SLOT_CAPACITY}}
+    try:
+        await db.slot_occupancy.update_one(guarded, {"$inc": {"booked": 1}}, upsert=True)
+        return True
+    except DuplicateKeyError:
+        # Either the slot is full or a concurrent upsert created it first
+        result = await db.slot_occupancy.update_one(guarded, {"$inc": {"booked": 1}})
+        return result.modified_count == 1
+    finally:
+        # After the write, so a concurrent read cannot cache the old counter again
+        invalidate_occupancy(key)
+
+# Booked counters per day, read by the agenda availability endpoints. Writes in this
+# process invalidate the day; the TTL bounds staleness from other workers.
+OCCUPANCY_CACHE_TTL = 30  # seconds
+OCCUPANCY_CACHE_MAX_DAYS = 2000
+_occupancy_cache: Dict[Tuple[str, str], Tuple[float, Dict[Tuple[str, str], int]]] = {}
+
+def invalidate_occupancy(key: Dict[str, str]):
+    _occupancy_cache.pop((key["ambulatorio"], key["data"]), None)
+
+async def get_day_occupancy(ambulatorio: str, days: List[str]) -> Dict[str, Dict[Tuple[str, str], int]]:
+    """{data: {(ora, tipo): booked}} for each day, querying only the days not cached"""
+    now = time.monotonic()
+    result = {}
+    missing = []
+    for day in days:
+        cached = _occupancy_cache.get((ambulatorio, day))
+        if cached and now - cached[0] < OCCUPANCY_CACHE_TTL:
+            result[day] = cached[1]
+        else:
+            missing.append(day)
+    if not missing:
+        return result
+    
+    fresh: Dict[str, Dict[Tuple[str, str], int]] = {day: {} for day in missing}
+    rows = await db.slot_occupancy.find(
+        {"ambulatorio": ambulatorio, "data": {"$in": missing}, "booked": {"$gt": 0}},
+        {"_id": 0, "data": 1, "ora": 1, "tipo": 1, "booked": 1}
+    ).to_list(None)
+    for row in rows:
+        fresh[row["data"]][(row["ora"], row["tipo"])] = row["booked"]
+    if len(_occupancy_cache) + len(fresh) > OCCUPANCY_CACHE_MAX_DAYS:
+        _occupancy_cache.clear()
+    for day, occupancy in fresh.items():
+        _occupancy_cache[(ambulatorio, day)] = (now, occupancy)
+    result.update(fresh)
+    return result
+
+async def reserve_slots(keys: List[Dict[str, str]]) -> List[bool]:
+    """Reserve several slots with one bulk write; result[i] tells whether keys[i] got a place"""
+    if not keys:
+        return []
+    failed = set()
+    try:
+        await db.slot_occupancy.bulk_write([
+            UpdateOne({**key, "booked": {"$lt": SLOT_CAPACITY}}, {"$inc": {"booked": 1}}, upsert=True)
+            for key in keys
+        ], ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(err["code"] != 11000 for err in errors):
+            raise
+        failed = {err["index"] for err in errors}
+    finally:
+        for key in keys:
+            invalidate_occupancy(key)
+    reserved = [True] * len(keys)
+    # Duplicate key: slot full or lost an upsert race, settle those one by one
+    for i in failed:
+        reserved[i] = await reserve_slot(keys[i])
+    return reserved
+
+async def run_in_transaction(operation):
+    """Run operation(session) in a transaction. Standalone servers, which reject
+    transactions before writing anything, run it without one"""
+    async with await client.start_session() as session:
+        try:
+            async with session.start_transaction():
+                return await operation(session)
+        except OperationFailure as e:
+            if e.code != 20:  # IllegalOperation: transactions need a replica set
+                raise
+    return await operation(None)
+
+async def release_slots(appointments: List[dict]):
+    counts: Dict[Tuple[str, ...], int] = {}
+    for appointment in appointments:
+        key = tuple(slot_key(appointment).values())
+        counts[key] = counts.get(key, 0) + 1
+    if not counts:
+        return
+    try:
+        await db.slot_occupancy.bulk_write([
+            UpdateOne({**dict(zip(SLOT_FIELDS, key)), "booked": {"$gte": n}}, {"$inc": {"booked": -n}})
+            for key, n in counts.items()
+        ])
+    finally:
+        for key in counts:
+            invalidate_occupancy(dict(zip(SLOT_FIELDS, key)))
+
+async def rebuild_slot_occupancy():
+    """Recompute every slot counter from the appointments collection, on the server"""
+    await db.slot_occupancy.delete_many({})
+    await db.appointments.aggregate([
+        {"$group": {"_id": {field: f"${field}" for field in SLOT_FIELDS}, "booked": {"$sum": 1}}},
+        {"$replaceWith": {"$mergeObjects": ["$_id", {"booked": "$booked"}]}},
+        {"$merge": {"into": "slot_occupancy", "on": list(SLOT_FIELDS), "whenMatched": "replace"}},
+    ]).to_list(None)
+    _occupancy_cache.clear()
+    slots = await db.slot_occupancy.count_documents({})
+    logger.info(f"Occupazione slot ricostruita: {slots} slot")
+    return slots
+
 # ============== APPOINTMENTS ROUTES ==============
 @api_router.post("/appointments", response_model=Appointment)
 async def create_appointment(data: AppointmentCreate, payload: dict = Depends(verify_token)):
@@ -530,25 +1219,260 @@ async def create_appointment(data: AppointmentCreate, payload: dict = Depends(ve
     if not patient:
         raise HTTPException(status_code=404, detail="Paziente non trovato")
     
-    # Check slot availability (max 2 per type per slot)
-    existing = await db.appointments.count_documents({
-        "ambulatorio": data.ambulatorio.value,
-        "data": data.data,
-        "ora": data.ora,
-        "tipo": data.tipo
-    })
-    if existing >= 2:
-        raise HTTPException(status_code=400, detail="Slot pieno (max 2 pazienti)")
-    
     appointment = Appointment(
         **data.model_dump(),
         patient_nome=patient["nome"],
         patient_cognome=patient["cognome"]
     )
     doc = appointment.model_dump()
-    await db.appointments.insert_one(doc)
+    
+    # Check slot availability (max 2 per type per slot)
+    if not await reserve_slot(slot_key(doc)):
+        raise HTTPException(status_code=400, detail="Slot pieno (max 2 pazienti)")
+    try:
+        await db.appointments.insert_one(doc)
+    except Exception:
+        await release_slots([doc])
+        raise
+    await apply_stats_rollup([doc], 1)
     return appointment
 
+MAX_SERIES_OCCURRENCES = 104
+
+@api_router.post("/appointments/series")
+async def create_appointment_series(data: AppointmentSeriesCreate, payload: dict = Depends(verify_token)):
+    """Book a recurring series (every N days, until a date or for a number of occurrences).
+    Closed days are skipped; each occurrence that cannot be booked is reported in conflitti"""
+    if data.ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    if data.ogni_giorni < 1:
+        raise HTTPException(status_code=400, detail="Intervallo di ricorrenza non valido")
+    if not data.fino_a and not data.occorrenze:
+        raise HTTPException(status_code=400, detail="Specificare fino_a oppure occorrenze")
+    
+    patient = await db.patients.find_one({"id": data.patient_id}, {"_id": 0, "nome": 1, "cognome": 1})
+    if not patient:
+        raise HTTPException(status_code=404, detail="Paziente non trovato")
+    
+    start = parse_date(data.data_inizio)
+    until = parse_date(data.fino_a) if data.fino_a else None
+    if data.occorrenze is not None and data.occorrenze < 1:
+        raise HTTPException(status_code=400, detail="Numero di occorrenze non valido")
+    occorrenze = data.occorrenze
+    if until is not None:
+        until_count = max((until - start).days // data.ogni_giorni + 1, 0)
+        occorrenze = min(occorrenze, until_count) if occorrenze else until_count
+    # Refuse rather than book a truncated series the caller would not notice
+    if occorrenze > MAX_SERIES_OCCURRENCES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"La serie supera il massimo di {MAX_SERIES_OCCURRENCES} appuntamenti ({occorrenze})"
+        )
+    dates = []
+    current = start
+    while len(dates) < occorrenze and (until is None or current <= until):
+        dates.append(current)
+        current += timedelta(days=data.ogni_giorni)
+    
+    holidays = holidays_between(start, dates[-1]) if dates else set()
+    conflitti = []
+    candidates = []
+    for d in dates:
+        if d.isoformat() in holidays:
+            conflitti.append({"data": d.isoformat(), "motivo": "Festivo"})
+        elif d.weekday() >= 5:
+            conflitti.append({"data": d.isoformat(), "motivo": "Ambulatorio chiuso"})
+        else:
+            candidates.append(d.isoformat())
+    
+    # One query for the whole series: slots already full are conflicts without trying
+    full = set(await db.slot_occupancy.distinct("data", {
+        "ambulatorio": data.ambulatorio.value,
+        "ora": data.ora,
+        "tipo": data.tipo,
+        "data": {"$in": candidates},
+        "booked": {"$gte": SLOT_CAPACITY}
+    }))
+    candidates = [day for day in candidates if day not in full]
+    
+    base = data.model_dump(exclude={"data_inizio", "ogni_giorni", "fino_a", "occorrenze"})
+    docs = [
+        Appointment(**base, data=day, patient_nome=patient["nome"], patient_cognome=patient["cognome"]).model_dump()
+        for day in candidates
+    ]
+    reserved = await reserve_slots([slot_key(doc) for doc in docs])
+    full |= {doc["data"] for doc, ok in zip(docs, reserved) if not ok}
+    docs = [doc for doc, ok in zip(docs, reserved) if ok]
+    conflitti += [{"data": day, "motivo": "Slot pieno (max 2 pazienti)"} for day in full]
+    
+    if docs:
+        try:
+            await db.appointments.insert_many(docs)
+        except Exception:
+            await release_slots(docs)
+            raise
+        await apply_stats_rollup(docs, 1)
+    
+    for doc in docs:
+        doc.pop("_id", None)
+    return {
+        "creati": docs,
+        "conflitti": sorted(conflitti, key=lambda c: c["data"])
+    }
+
+def plan_reschedule(appointments: List[dict], target_days: List[str], booked: Dict[Tuple[str, str, str], int],
+                    solo_stessa_ora: bool) -> Tuple[List[Tuple[dict, dict]], List[dict]]:
+    """(original, moved) pairs and the appointments that fit nowhere. Each appointment takes the
+    first target day with a free place at its own time, then (unless solo_stessa_ora) at any time.
+    booked is updated with the places the plan takes"""
+    plan = []
+    non_spostati = []
+    for appointment in appointments:
+        orari = [appointment["ora"]]
+        if not solo_stessa_ora:
+            orari += [ora for ora in ALL_SLOTS if ora != appointment["ora"]]
+        target = next(
+            ((day, ora) for day in target_days for ora in orari
+             if booked.get((day, ora, appointment["tipo"]), 0) < SLOT_CAPACITY),
+            None
+        )
+        if target is None:
+            non_spostati.append({
+                "id": appointment["id"],
+                "ora": appointment["ora"],
+                "patient_cognome": appointment.get("patient_cognome"),
+                "patient_nome": appointment.get("patient_nome"),
+                "motivo": "Nessuno slot libero"
+            })
+            continue
+        key = (target[0], target[1], appointment["tipo"])
+        booked[key] = booked.get(key, 0) + 1
+        plan.append((appointment, {**appointment, "data": target[0], "ora": target[1]}))
+    return plan, non_spostati
+
+@api_router.post("/appointments/reschedule")
+async def reschedule_appointments(data: AppointmentReschedule, payload: dict = Depends(verify_token)):
+    """Move the appointments of a day (or a filtered subset) to the target days.
+    Each appointment keeps its time when possible; the ones that fit nowhere are reported"""
+    if data.ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    targets = [parse_date(d) for d in data.date_destinazione]
+    holidays = holidays_between(min(targets), max(targets)) if targets else set()
+    target_days = []
+    for d in targets:
+        if d.isoformat() not in target_days and d.isoformat() not in holidays and d.weekday() < 5:
+            target_days.append(d.isoformat())
+    if not target_days:
+        raise HTTPException(status_code=400, detail="Nessuna data di destinazione lavorativa")
+    
+    query = {"ambulatorio": data.ambulatorio.value, "data": data.data}
+    if data.tipo:
+        query["tipo"] = data.tipo
+    if data.ora:
+        query["ora"] = data.ora
+    if data.appointment_ids:
+        query["id"] = {"$in": data.appointment_ids}
+    appointments = await db.appointments.find(query, {"_id": 0}).sort("ora", 1).to_list(None)
+    
+    # Plan against fresh counters
+    booked = {}
+    async for row in db.slot_occupancy.find({"ambulatorio": data.ambulatorio.value, "data": {"$in": target_days}}):
+        booked[(row["data"], row["ora"], row["tipo"])] = row["booked"]
+    plan, non_spostati = plan_reschedule(appointments, target_days, booked, data.solo_stessa_ora)
+    
+    if plan:
+        def slot_counts(appointments: List[dict]) -> List[Tuple[Dict[str, str], int]]:
+            counts: Dict[Tuple[str, ...], int] = {}
+            for appointment in appointments:
+                key = tuple(slot_key(appointment).values())
+                counts[key] = counts.get(key, 0) + 1
+            return [(dict(zip(SLOT_FIELDS, key)), n) for key, n in counts.items()]
+        
+        taken = slot_counts([moved for _, moved in plan])
+        freed = slot_counts([original for original, _ in plan])
+        reservations = [
+            UpdateOne({**key, "booked": {"$lte": SLOT_CAPACITY - n}}, {"$inc": {"booked": n}}, upsert=True)
+            for key, n in taken
+        ]
+        releases = [UpdateOne({**key, "booked": {"$gte": n}}, {"$inc": {"booked": -n}}) for key, n in freed]
+        moves = [
+            UpdateOne({"id": moved["id"], "data": data.data}, {"$set": {"data": moved["data"], "ora": moved["ora"]}})
+            for _, moved in plan
+        ]
+        
+        async def write(session):
+            try:
+                await db.slot_occupancy.bulk_write(reservations, session=session)
+            except BulkWriteError as e:
+                if session is None:
+                    # No transaction to roll back: undo the reservations that went through
+                    done = taken[:e.details["writeErrors"][0]["index"]]
+                    if done:
+                        await db.slot_occupancy.bulk_write([
+                            UpdateOne(key, {"$inc": {"booked": -n}}) for key, n in done
+                        ])
+                raise HTTPException(status_code=409, detail="Agenda modificata nel frattempo, riprovare")
+            await db.slot_occupancy.bulk_write(releases, session=session)
+            result = await db.appointments.bulk_write(moves, session=session)
+            if result.matched_count != len(moves):
+                # An appointment was deleted or moved since it was read: its counters would drift
+                if session is None:
+                    # No transaction to roll back: put the moved appointments and the counters back
+                    await db.appointments.bulk_write([
+                        UpdateOne(
+                            {"id": moved["id"], "data": moved["data"], "ora": moved["ora"]},
+                            {"$set": {"data": original["data"], "ora": original["ora"]}}
+                        )
+                        for original, moved in plan
+                    ])
+                    await db.slot_occupancy.bulk_write(
+                        [UpdateOne(key, {"$inc": {"booked": -n}}) for key, n in taken]
+                        + [UpdateOne(key, {"$inc": {"booked": n}}) for key, n in freed]
+                    )
+                raise HTTPException(status_code=409, detail="Agenda modificata nel frattempo, riprovare")
+        
+        try:
+            await run_in_transaction(write)
+        finally:
+            for key, _ in taken + freed:
+                invalidate_occupancy(key)
+        await apply_stats_rollup([original for original, _ in plan], -1)
+        await apply_stats_rollup([moved for _, moved in plan], 1)
+    
+    return {
+        "spostati": [
+            {"id": moved["id"], "da": {"data": original["data"], "ora": original["ora"]}, "a": {"data": moved["data"], "ora": moved["ora"]}}
+            for original, moved in plan
+        ],
+        "non_spostati": non_spostati
+    }
+
+@api_router.post("/appointments/complete")
+async def complete_appointments(data: AppointmentBulkComplete, payload: dict = Depends(verify_token)):
+    """Mark a list of appointments, a slot or a whole day as completed with a single update_many"""
+    if data.ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    if not data.appointment_ids and not data.data:
+        raise HTTPException(status_code=400, detail="Specificare appointment_ids oppure data")
+    
+    # The ambulatorio in the filter doubles as the access check for every id
+    query = {"ambulatorio": data.ambulatorio.value}
+    if data.appointment_ids:
+        query["id"] = {"$in": data.appointment_ids}
+    if data.data:
+        query["data"] = data.data
+    if data.ora:
+        query["ora"] = data.ora
+    if data.tipo:
+        query["tipo"] = data.tipo
+    
+    result = await db.appointments.update_many(query, {"$set": {"completed": data.completed}})
+    return {
+        "trovati": result.matched_count,
+        "aggiornati": result.modified_count
+    }
+
 @api_router.get("/appointments", response_model=List[Appointment])
 async def get_appointments(
     ambulatorio: Ambulatorio,
@@ -556,6 +1480,8 @@ async def get_appointments(
     data_from: Optional[str] = None,
     data_to: Optional[str] = None,
     tipo: Optional[str] = None,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
     payload: dict = Depends(verify_token)
 ):
     if ambulatorio.value not in payload["ambulatori"]:
@@ -569,19 +1495,45 @@ async def get_appointments(
     if tipo:
         query["tipo"] = tipo
     
-    appointments = await db.appointments.find(query, {"_id": 0}).sort([("data", 1), ("ora", 1)]).to_list(1000)
+    projection = list_projection(Appointment, fields, view)
+    appointments = await db.appointments.find(query, projection or {"_id": 0}).sort([("data", 1), ("ora", 1)]).to_list(1000)
+    if projection:
+        return JSONResponse(appointments)
     return appointments
 
 @api_router.put("/appointments/{appointment_id}", response_model=Appointment)
 async def update_appointment(appointment_id: str, data: dict, payload: dict = Depends(verify_token)):
-    appointment = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
-    if not appointment:
-        raise HTTPException(status_code=404, detail="Appuntamento non trovato")
-    if appointment["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    await db.appointments.update_one({"id": appointment_id}, {"$set": data})
-    updated = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
+    if set(SLOT_FIELDS) & data.keys():
+        # Possible move: the current slot is needed before reserving the new one
+        appointment = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
+        if not appointment:
+            raise HTTPException(status_code=404, detail="Appuntamento non trovato")
+        if appointment["ambulatorio"] not in payload["ambulatori"]:
+            raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+        
+        target = {**appointment, **data}
+        moved = slot_key(target) != slot_key(appointment)
+        if moved and not await reserve_slot(slot_key(target)):
+            raise HTTPException(status_code=400, detail="Slot pieno (max 2 pazienti)")
+        
+        try:
+            updated = await update_with_access(db.appointments, appointment_id, {"$set": data}, payload, "Appuntamento non trovato")
+        except Exception:
+            if moved:
+                await release_slots([target])
+            raise
+        if moved:
+            await release_slots([appointment])
+    else:
+        # Same slot: one round trip, the previous version is only needed for the rollups
+        appointment = await update_with_access(
+            db.appointments, appointment_id, {"$set": data}, payload, "Appuntamento non trovato",
+            return_document=ReturnDocument.BEFORE
+        )
+        updated = {**appointment, **data}
+    if ROLLUP_FIELDS & data.keys():
+        await apply_stats_rollup([appointment], -1)
+        await apply_stats_rollup([updated], 1)
     return updated
 
 @api_router.delete("/appointments/{appointment_id}")
@@ -593,6 +1545,8 @@ async def delete_appointment(appointment_id: str, payload: dict = Depends(verify
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     await db.appointments.delete_one({"id": appointment_id})
+    await release_slots([appointment])
+    await apply_stats_rollup([appointment], -1)
     return {"message": "Appuntamento eliminato"}
 
 # ============== SCHEDE MEDICAZIONE MED ==============
@@ -610,15 +1564,20 @@ async def create_scheda_medicazione_med(data: SchedaMedicazioneMEDCreate, payloa
 async def get_schede_medicazione_med(
     patient_id: str,
     ambulatorio: Ambulatorio,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
     payload: dict = Depends(verify_token)
 ):
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
+    projection = list_projection(SchedaMedicazioneMED, fields, view)
     schede = await db.schede_medicazione_med.find(
         {"patient_id": patient_id, "ambulatorio": ambulatorio.value},
-        {"_id": 0}
+        projection or {"_id": 0}
     ).sort("data_compilazione", -1).to_list(1000)
+    if projection:
+        return JSONResponse(schede)
     return schede
 
 @api_router.get("/schede-medicazione-med/{scheda_id}", response_model=SchedaMedicazioneMED)
@@ -632,15 +1591,7 @@ async def get_scheda_medicazione_med(scheda_id: str, payload: dict = Depends(ver
 
 @api_router.put("/schede-medicazione-med/{scheda_id}", response_model=SchedaMedicazioneMED)
 async def update_scheda_medicazione_med(scheda_id: str, data: dict, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_medicazione_med.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    await db.schede_medicazione_med.update_one({"id": scheda_id}, {"$set": data})
-    updated = await db.schede_medicazione_med.find_one({"id": scheda_id}, {"_id": 0})
-    return updated
+    return await update_with_access(db.schede_medicazione_med, scheda_id, {"$set": data}, payload, "Scheda non trovata")
 
 # ============== SCHEDE IMPIANTO PICC ==============
 @api_router.post("/schede-impianto-picc", response_model=SchedaImpiantoPICC)
@@ -657,28 +1608,25 @@ async def create_scheda_impianto_picc(data: SchedaImpiantoPICCCreate, payload: d
 async def get_schede_impianto_picc(
     patient_id: str,
     ambulatorio: Ambulatorio,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
     payload: dict = Depends(verify_token)
 ):
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
+    projection = list_projection(SchedaImpiantoPICC, fields, view)
     schede = await db.schede_impianto_picc.find(
         {"patient_id": patient_id, "ambulatorio": ambulatorio.value},
-        {"_id": 0}
+        projection or {"_id": 0}
     ).sort("data_impianto", -1).to_list(1000)
+    if projection:
+        return JSONResponse(schede)
     return schede
 
 @api_router.put("/schede-impianto-picc/{scheda_id}", response_model=SchedaImpiantoPICC)
 async def update_scheda_impianto_picc(scheda_id: str, data: dict, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    await db.schede_impianto_picc.update_one({"id": scheda_id}, {"$set": data})
-    updated = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
-    return updated
+    return await update_with_access(db.schede_impianto_picc, scheda_id, {"$set": data}, payload, "Scheda non trovata")
 
 # Generate PDF for Scheda Impianto PICC in official format
 @api_router.get("/schede-impianto-picc/{scheda_id}/pdf")
@@ -907,6 +1855,66 @@ def generate_scheda_impianto_pdf(scheda: dict, patient: dict) -> bytes:
 
 
 # ============== SCHEDE GESTIONE PICC (MENSILE) ==============
+# Storage codec for giorni. Each day is stored as
+#   {"s": bits of the items answered "Sì", "n": bits answered "No", "x": bits marked "X", "v": {other cells}}
+# instead of ~29 long keys per day. Only those exact strings (the quick answers of the grid) go
+# into the bitmasks, every other value, "" included, is kept verbatim in "v", so decoding is lossless.
+# Bit positions are persisted: only ever append to this list.
+GESTIONE_FLAG_ITEMS = [
+    "uso_precauzioni_barriera", "lavaggio_mani", "guanti_non_sterili", "cambio_guanti_sterili",
+    "rimozione_medicazione_sutureless", "rimozione_medicazione_straordinaria", "ispezione_sito",
+    "sito_dolente", "edema_arrossamento", "disinfezione_sito", "fissaggio_sutureless",
+    "medicazione_trasparente", "lavaggio_fisiologica", "disinfezione_clorexidina",
+    "difficolta_aspirazione", "difficolta_iniezione", "medicazione_clorexidina_prolungato",
+    "port_protector", "lock_eparina", "sostituzione_set", "febbre", "emocoltura",
+    "emocoltura_positiva", "trasferimento", "rimozione_cvc",
+]
+GESTIONE_FLAG_BITS = {item: 1 << i for i, item in enumerate(GESTIONE_FLAG_ITEMS)}
+GESTIONE_FLAG_VALUES = {"Sì": "s", "No": "n", "X": "x"}
+PACKED_DAY_KEYS = ("s", "n", "x", "v")
+
+def encode_gestione_day(day: Dict[str, Any]) -> Dict[str, Any]:
+    masks = {key: 0 for key in GESTIONE_FLAG_VALUES.values()}
+    values = {}
+    for campo, valore in day.items():
+        bit = GESTIONE_FLAG_BITS.get(campo)
+        if bit and isinstance(valore, str) and valore in GESTIONE_FLAG_VALUES:
+            masks[GESTIONE_FLAG_VALUES[valore]] |= bit
+        else:
+            values[campo] = valore
+    packed = {key: Int64(mask) for key, mask in masks.items() if mask}
+    if values:
+        packed["v"] = values
+    return packed
+
+def decode_gestione_day(day: Dict[str, Any]) -> Dict[str, Any]:
+    # Keys outside s/n/v are cells of a day written before the codec
+    decoded = {k: v for k, v in day.items() if k not in PACKED_DAY_KEYS}
+    decoded.update(day.get("v") or {})
+    for valore, key in GESTIONE_FLAG_VALUES.items():
+        mask = day.get(key) or 0
+        for item, bit in GESTIONE_FLAG_BITS.items():
+            if mask & bit:
+                decoded[item] = valore
+    return decoded
+
+def encode_giorni(giorni: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    return {giorno: encode_gestione_day(day) for giorno, day in giorni.items()}
+
+def decode_scheda_gestione(scheda: dict) -> dict:
+    scheda["giorni"] = {giorno: decode_gestione_day(day) for giorno, day in (scheda.get("giorni") or {}).items()}
+    return scheda
+
+async def migrate_gestione_giorni():
+    """Re-encode the giorni of every scheda gestione with the compact codec (idempotent)"""
+    migrated = 0
+    async for scheda in db.schede_gestione_picc.find({}, {"_id": 0, "id": 1, "giorni": 1}):
+        giorni = decode_scheda_gestione(scheda)["giorni"]
+        await db.schede_gestione_picc.update_one({"id": scheda["id"]}, {"$set": {"giorni": encode_giorni(giorni)}})
+        migrated += 1
+    logger.info(f"Schede gestione convertite: {migrated}")
+    return migrated
+
 @api_router.post("/schede-gestione-picc", response_model=SchedaGestionePICC)
 async def create_scheda_gestione_picc(data: SchedaGestionePICCCreate, payload: dict = Depends(verify_token)):
     if data.ambulatorio.value not in payload["ambulatori"]:
@@ -923,6 +1931,7 @@ async def create_scheda_gestione_picc(data: SchedaGestionePICCCreate, payload: d
     
     scheda = SchedaGestionePICC(**data.model_dump())
     doc = scheda.model_dump()
+    doc["giorni"] = encode_giorni(doc["giorni"])
     await db.schede_gestione_picc.insert_one(doc)
     return scheda
 
@@ -931,6 +1940,8 @@ async def get_schede_gestione_picc(
     patient_id: str,
     ambulatorio: Ambulatorio,
     mese: Optional[str] = None,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
     payload: dict = Depends(verify_token)
 ):
     if ambulatorio.value not in payload["ambulatori"]:
@@ -940,21 +1951,265 @@ async def get_schede_gestione_picc(
     if mese:
         query["mese"] = mese
     
-    schede = await db.schede_gestione_picc.find(query, {"_id": 0}).sort("mese", -1).to_list(100)
-    return schede
+    projection = list_projection(SchedaGestionePICC, fields, view)
+    schede = await db.schede_gestione_picc.find(query, projection or {"_id": 0}).sort("mese", -1).to_list(100)
+    if projection:
+        return JSONResponse([decode_scheda_gestione(scheda) if "giorni" in scheda else scheda for scheda in schede])
+    return [decode_scheda_gestione(scheda) for scheda in schede]
 
 @api_router.put("/schede-gestione-picc/{scheda_id}", response_model=SchedaGestionePICC)
 async def update_scheda_gestione_picc(scheda_id: str, data: dict, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_gestione_picc.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
     data["updated_at"] = datetime.now(timezone.utc).isoformat()
-    await db.schede_gestione_picc.update_one({"id": scheda_id}, {"$set": data})
-    updated = await db.schede_gestione_picc.find_one({"id": scheda_id}, {"_id": 0})
-    return updated
+    if "giorni" in data:
+        data["giorni"] = encode_giorni(data["giorni"] or {})
+    updated = await update_with_access(db.schede_gestione_picc, scheda_id, {"$set": data}, payload, "Scheda non trovata")
+    return decode_scheda_gestione(updated)
+
+def gestione_field_path(*parts: str) -> str:
+    for part in parts:
+        if not part or "." in part or part.startswith("$"):
+            raise HTTPException(status_code=400, detail=f"Chiave non valida: {part}")
+    return ".".join(("giorni",) + parts)
+
+def gestione_patch_update(modifiche: List[GestioneCellUpdate]) -> Dict[str, Any]:
+    """MongoDB update for a batch of day/cell changes; raises 400 on invalid or conflicting paths"""
+    to_set: Dict[str, Any] = {}
+    to_unset: Dict[str, str] = {}
+    bit_ops: Dict[str, Dict[str, int]] = {}  # path -> {"and": mask, "or": mask}, applied in that order
+    
+    def assign(path: str, valore: Any):
+        to_set.pop(path, None)
+        to_unset.pop(path, None)
+        if valore is None:
+            to_unset[path] = ""
+        else:
+            to_set[path] = valore
+    
+    for change in modifiche:
+        day_path = gestione_field_path(change.giorno)
+        if not change.campo:
+            if change.valore is not None and not isinstance(change.valore, dict):
+                raise HTTPException(status_code=400, detail="Il valore di un giorno deve essere un oggetto")
+            assign(day_path, encode_gestione_day(change.valore) if change.valore is not None else None)
+            continue
+        if change.campo in PACKED_DAY_KEYS:
+            raise HTTPException(status_code=400, detail=f"Campo riservato: {change.campo}")
+        
+        # Drop any copy of the cell stored before the codec
+        assign(gestione_field_path(change.giorno, change.campo), None)
+        valore = change.valore
+        bit = GESTIONE_FLAG_BITS.get(change.campo)
+        if bit:
+            for key in GESTIONE_FLAG_VALUES.values():
+                ops = bit_ops.setdefault(f"{day_path}.{key}", {"and": -1, "or": 0})
+                ops["and"] &= ~bit
+                ops["or"] &= ~bit
+            if isinstance(valore, str) and valore in GESTIONE_FLAG_VALUES:
+                bit_ops[f"{day_path}.{GESTIONE_FLAG_VALUES[valore]}"]["or"] |= bit
+                valore = None
+        assign(f"{day_path}.v.{change.campo}", valore)
+    
+    # A day and one of its cells in the same request would collide in MongoDB
+    paths = set(to_set) | set(to_unset) | set(bit_ops)
+    for path in paths:
+        parts = path.split(".")
+        for i in range(1, len(parts)):
+            if ".".join(parts[:i]) in paths:
+                raise HTTPException(status_code=400, detail=f"Modifiche in conflitto: {'.'.join(parts[:i])}")
+    
+    update = {"$set": to_set}
+    if to_unset:
+        update["$unset"] = to_unset
+    if bit_ops:
+        update["$bit"] = {path: {"and": Int64(ops["and"]), "or": Int64(ops["or"])} for path, ops in bit_ops.items()}
+    return update
+
+@api_router.patch("/schede-gestione-picc/{scheda_id}/giorni")
+async def patch_scheda_gestione_giorni(scheda_id: str, data: GestioneGiorniPatch, payload: dict = Depends(verify_token)):
+    """Apply a batch of cell or day changes with dotted paths, so the write and the payload
+    are proportional to the edit instead of the whole month. Checklist answers flip bits
+    in place with $bit, without reading the day first"""
+    if not data.modifiche:
+        raise HTTPException(status_code=400, detail="Nessuna modifica")
+    
+    update = gestione_patch_update(data.modifiche)
+    update["$set"]["updated_at"] = datetime.now(timezone.utc).isoformat()
+    return await update_with_access(
+        db.schede_gestione_picc, scheda_id, update, payload, "Scheda non trovata",
+        projection={"_id": 0, "id": 1, "updated_at": 1}
+    )
+
+# ============== BLOB STORE ==============
+BLOB_CHUNK_SIZE = 255 * 1024  # GridFS default chunk size
+
+async def store_blob(source: UploadFile, filename: str, mime_type: Optional[str]) -> Dict[str, Any]:
+    """Stream an upload into GridFS chunk by chunk, never holding the whole file in memory"""
+    digest = hashlib.sha256()
+    size = 0
+    grid_in = fs.open_upload_stream(filename, chunk_size_bytes=BLOB_CHUNK_SIZE, metadata={"mime_type": mime_type})
+    try:
+        while True:
+            chunk = await source.read(BLOB_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+            await grid_in.write(chunk)
+    except Exception:
+        await grid_in.abort()
+        raise
+    await grid_in.close()
+    return {"blob_id": str(grid_in._id), "size": size, "sha256": digest.hexdigest()}
+
+async def store_blob_bytes(contents: bytes, filename: str, mime_type: Optional[str]) -> Dict[str, Any]:
+    """Store bytes already in memory (migrations, generated files)"""
+    blob_id = await fs.upload_from_stream(
+        filename, contents, chunk_size_bytes=BLOB_CHUNK_SIZE, metadata={"mime_type": mime_type}
+    )
+    return {"blob_id": str(blob_id), "size": len(contents), "sha256": hashlib.sha256(contents).hexdigest()}
+
+async def read_blob(blob_id: str) -> bytes:
+    grid_out = await fs.open_download_stream(ObjectId(blob_id))
+    return await grid_out.read()
+
+async def iter_blob(blob_id: str, start: int, end: int) -> AsyncIterator[bytes]:
+    """Yield bytes start..end (inclusive) of a blob without loading it whole"""
+    grid_out = await fs.open_download_stream(ObjectId(blob_id))
+    grid_out.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        chunk = await grid_out.read(min(BLOB_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+async def iter_bytes(contents: bytes, start: int, end: int) -> AsyncIterator[bytes]:
+    for offset in range(start, end + 1, BLOB_CHUNK_SIZE):
+        yield contents[offset:min(offset + BLOB_CHUNK_SIZE, end + 1)]
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single 'bytes=start-end' range. Returns None to serve the whole file,
+    raises 416 when the range cannot be satisfied"""
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_s, _, end_s = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start_s:
+            start = int(start_s)
+            end = int(end_s) if end_s else size - 1
+        else:
+            # Suffix range: last N bytes
+            start = max(size - int(end_s), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range non valido", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+async def delete_blob(blob_id: Optional[str]):
+    if not blob_id:
+        return
+    try:
+        await fs.delete(ObjectId(blob_id))
+    except NoFile:
+        pass
+
+async def with_image_data(photo: dict) -> dict:
+    """Fill image_data from the blob store for clients that still expect inline base64"""
+    if not photo.get("image_data") and photo.get("blob_id"):
+        photo["image_data"] = base64.b64encode(await read_blob(photo["blob_id"])).decode('utf-8')
+    return photo
+
+async def migrate_inline_photos():
+    """Move base64 image_data of legacy photo documents into the blob store"""
+    moved = 0
+    cursor = db.photos.find(
+        {"image_data": {"$nin": [None, ""]}, "blob_id": None},
+        {"_id": 0, "id": 1, "image_data": 1, "original_name": 1, "mime_type": 1}
+    )
+    async for photo in cursor:
+        contents = base64.b64decode(photo["image_data"])
+        blob = await store_blob_bytes(contents, photo.get("original_name") or photo["id"], photo.get("mime_type"))
+        await db.photos.update_one({"id": photo["id"]}, {"$set": blob, "$unset": {"image_data": ""}})
+        moved += 1
+    logger.info(f"Foto migrate nel blob store: {moved}")
+    return moved
+
+# ============== THUMBNAILS ==============
+THUMBNAIL_SIZES = (160, 640)  # longest side in px
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_MIME = "image/webp"
+
+_thumbnail_pool: Optional[ProcessPoolExecutor] = None
+
+def get_thumbnail_pool() -> ProcessPoolExecutor:
+    """Image decoding is CPU bound: keep it in worker processes, off the event loop"""
+    global _thumbnail_pool
+    if _thumbnail_pool is None:
+        _thumbnail_pool = ProcessPoolExecutor(max_workers=int(os.environ.get('THUMBNAIL_WORKERS', '2')))
+    return _thumbnail_pool
+
+def render_thumbnails(contents: bytes, sizes: Tuple[int, ...]) -> Dict[int, bytes]:
+    """Runs in the process pool: returns encoded thumbnails keyed by size"""
+    rendered = {}
+    with PILImage.open(io.BytesIO(contents)) as img:
+        # Let the JPEG decoder downscale while decoding when the original is large
+        img.draft("RGB", (max(sizes), max(sizes)))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        for size in sizes:
+            thumb = img.copy()
+            thumb.thumbnail((size, size), PILImage.LANCZOS)
+            buffer = io.BytesIO()
+            thumb.save(buffer, THUMBNAIL_FORMAT, quality=80)
+            rendered[size] = buffer.getvalue()
+    return rendered
+
+async def generate_thumbnails(photo: dict) -> Dict[str, Dict[str, Any]]:
+    """Render and store every thumbnail size for a photo, returning the references saved on it"""
+    if photo.get("blob_id"):
+        contents = await read_blob(photo["blob_id"])
+    else:
+        contents = base64.b64decode(photo.get("image_data") or "")
+    
+    loop = asyncio.get_running_loop()
+    try:
+        rendered = await loop.run_in_executor(get_thumbnail_pool(), render_thumbnails, contents, THUMBNAIL_SIZES)
+    except BrokenExecutor as e:
+        # The pool died (e.g. a worker was killed): not the image's fault, a later request retries
+        logger.warning(f"Miniature non generate per la foto {photo['id']}: {e}")
+        return {}
+    except Exception as e:
+        # Unsupported or corrupt file: remember it, every later request would decode it again
+        logger.warning(f"Miniature non generate per la foto {photo['id']}: {e}")
+        await db.photos.update_one(
+            {"id": photo["id"], "thumbnails": {"$in": [None, {}]}},
+            {"$set": {"thumbnail_error": f"{type(e).__name__}: {e}"[:200]}}
+        )
+        return {}
+    
+    thumbnails = {}
+    for size, data in rendered.items():
+        thumbnails[str(size)] = await store_blob_bytes(data, f"{photo['id']}_{size}.{THUMBNAIL_FORMAT.lower()}", THUMBNAIL_MIME)
+    
+    # Only the first writer wins: a concurrent request or a deleted photo leaves our copies unused
+    result = await db.photos.update_one(
+        {"id": photo["id"], "thumbnails": {"$in": [None, {}]}},
+        {"$set": {"thumbnails": thumbnails}}
+    )
+    if result.modified_count == 0:
+        for thumbnail in thumbnails.values():
+            await delete_blob(thumbnail["blob_id"])
+        current = await db.photos.find_one({"id": photo["id"]}, {"_id": 0, "thumbnails": 1})
+        return (current or {}).get("thumbnails") or {}
+    return thumbnails
+
+def photo_blob_ids(photo: dict) -> List[str]:
+    """Original plus thumbnails: everything to remove from the blob store with the photo"""
+    blob_ids = [photo.get("blob_id")]
+    blob_ids += [t.get("blob_id") for t in (photo.get("thumbnails") or {}).values()]
+    return [b for b in blob_ids if b]
 
 # ============== PHOTOS / ATTACHMENTS ==============
 @api_router.post("/photos")
@@ -968,14 +2223,12 @@ async def upload_photo(
     original_name: Optional[str] = Form(None),
     scheda_med_id: Optional[str] = Form(None),
     file: UploadFile = File(...),
+    background_tasks: BackgroundTasks = None,
     payload: dict = Depends(verify_token)
 ):
     if ambulatorio not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    contents = await file.read()
-    image_data = base64.b64encode(contents).decode('utf-8')
-    
     # Determine file type from content type if not provided
     mime_type = file.content_type
     if not file_type or file_type == "image":
@@ -988,30 +2241,65 @@ async def upload_photo(
         elif mime_type and mime_type.startswith('image/'):
             file_type = 'image'
     
+    blob = await store_blob(file, original_name or file.filename or "file", mime_type)
+    
     photo = Photo(
         patient_id=patient_id,
         ambulatorio=Ambulatorio(ambulatorio),
         tipo=tipo,
         descrizione=descrizione,
         data=data,
-        image_data=image_data,
         file_type=file_type,
         original_name=original_name or file.filename,
         mime_type=mime_type,
-        scheda_med_id=scheda_med_id if scheda_med_id != "pending" else None
+        scheda_med_id=scheda_med_id if scheda_med_id != "pending" else None,
+        **blob
     )
     doc = photo.model_dump()
     await db.photos.insert_one(doc)
     
+    if file_type == "image":
+        background_tasks.add_task(generate_thumbnails, photo.model_dump())
+    
     return {"id": photo.id, "message": "File caricato"}
 
+PHOTO_METADATA_FIELDS = [
+    "id", "patient_id", "ambulatorio", "tipo", "descrizione", "data", "file_type",
+    "original_name", "mime_type", "scheda_med_id", "size", "created_at", "thumbnail_error",
+]
+
+def encode_cursor(values: Dict[str, Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str, keys: Tuple[str, ...]) -> Dict[str, Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if not isinstance(values, dict) or any(k not in values for k in keys):
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+    return values
+
+def photo_urls(photo: dict) -> dict:
+    photo["content_url"] = f"{api_router.prefix}/photos/{photo['id']}/content"
+    if photo.get("file_type") in (None, "image") and not photo.get("thumbnail_error"):
+        photo["thumbnail_urls"] = {
+            str(size): f"{api_router.prefix}/photos/{photo['id']}/thumbnail/{size}" for size in THUMBNAIL_SIZES
+        }
+    return photo
+
 @api_router.get("/photos")
 async def get_photos(
     patient_id: str,
     ambulatorio: Ambulatorio,
     tipo: Optional[str] = None,
+    view: str = "full",
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
     payload: dict = Depends(verify_token)
 ):
+    """view=full: legacy list with inline image_data.
+    view=metadata: metadata and URLs only, paginated on (data, id) with next_cursor"""
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
@@ -1019,8 +2307,26 @@ async def get_photos(
     if tipo:
         query["tipo"] = tipo
     
-    photos = await db.photos.find(query, {"_id": 0}).sort("data", -1).to_list(100)
-    return photos
+    if view != "metadata":
+        photos = await db.photos.find(query, {"_id": 0}).sort("data", -1).to_list(100)
+        return await asyncio.gather(*[with_image_data(photo) for photo in photos])
+    
+    if cursor:
+        after = decode_cursor(cursor, ("data", "id"))
+        query["$or"] = [
+            {"data": {"$lt": after["data"]}},
+            {"data": after["data"], "id": {"$lt": after["id"]}},
+        ]
+    projection = {field: 1 for field in PHOTO_METADATA_FIELDS}
+    projection["_id"] = 0
+    # One extra document tells whether another page exists
+    photos = await db.photos.find(query, projection).sort([("data", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    
+    next_cursor = None
+    if len(photos) > limit:
+        photos = photos[:limit]
+        next_cursor = encode_cursor({"data": photos[-1]["data"], "id": photos[-1]["id"]})
+    return {"items": [photo_urls(photo) for photo in photos], "next_cursor": next_cursor}
 
 @api_router.get("/photos/{photo_id}")
 async def get_photo(photo_id: str, payload: dict = Depends(verify_token)):
@@ -1029,7 +2335,87 @@ async def get_photo(photo_id: str, payload: dict = Depends(verify_token)):
         raise HTTPException(status_code=404, detail="Foto non trovata")
     if photo["ambulatorio"] not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    return photo
+    return await with_image_data(photo)
+
+PHOTO_CACHE_CONTROL = "private, max-age=3600"
+
+def serve_blob(request: Request, blob: Dict[str, Any], mime_type: Optional[str], filename: str,
+               contents: Optional[bytes] = None):
+    """Stream a stored blob honouring If-None-Match, Range and If-Range.
+    `contents` is given only for legacy inline photos"""
+    size = blob["size"]
+    etag = f'"{blob["sha256"]}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": PHOTO_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if not if_range or if_range.strip() == etag:
+        byte_range = parse_range(request.headers.get("range"), size)
+    
+    start, end = byte_range if byte_range else (0, size - 1)
+    headers["Content-Length"] = str(end - start + 1 if size else 0)
+    headers["Content-Disposition"] = f"inline; filename*=UTF-8''{quote(filename)}"
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    
+    if not size:
+        body = iter_bytes(b"", 0, -1)
+    elif contents is None:
+        body = iter_blob(blob["blob_id"], start, end)
+    else:
+        body = iter_bytes(contents, start, end)
+    return StreamingResponse(
+        body,
+        status_code=206 if byte_range else 200,
+        media_type=mime_type or "application/octet-stream",
+        headers=headers
+    )
+
+@api_router.get("/photos/{photo_id}/content")
+async def get_photo_content(photo_id: str, request: Request, payload: dict = Depends(verify_token)):
+    """Raw bytes of a photo/attachment with Range, ETag and conditional GET support"""
+    photo = await db.photos.find_one({"id": photo_id}, {"_id": 0})
+    if not photo:
+        raise HTTPException(status_code=404, detail="Foto non trovata")
+    if photo["ambulatorio"] not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    filename = photo.get("original_name") or photo_id
+    if photo.get("blob_id"):
+        return serve_blob(request, photo, photo.get("mime_type"), filename)
+    # Legacy document with inline base64
+    contents = base64.b64decode(photo.get("image_data") or "")
+    blob = {"size": len(contents), "sha256": hashlib.sha256(contents).hexdigest()}
+    return serve_blob(request, blob, photo.get("mime_type"), filename, contents)
+
+@api_router.get("/photos/{photo_id}/thumbnail/{size}")
+async def get_photo_thumbnail(photo_id: str, size: int, request: Request, payload: dict = Depends(verify_token)):
+    """Thumbnail of an image, generated on first request if the upload task has not produced it yet"""
+    if size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=404, detail="Dimensione miniatura non disponibile")
+    photo = await db.photos.find_one({"id": photo_id}, {"_id": 0})
+    if not photo:
+        raise HTTPException(status_code=404, detail="Foto non trovata")
+    if photo["ambulatorio"] not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    if photo.get("file_type") not in (None, "image"):
+        raise HTTPException(status_code=404, detail="Miniatura disponibile solo per le immagini")
+    
+    thumbnail = (photo.get("thumbnails") or {}).get(str(size))
+    if not thumbnail and photo.get("thumbnail_error"):
+        raise HTTPException(status_code=422, detail="Impossibile generare la miniatura")
+    if not thumbnail:
+        thumbnail = (await generate_thumbnails(photo)).get(str(size))
+    if not thumbnail:
+        raise HTTPException(status_code=422, detail="Impossibile generare la miniatura")
+    return serve_blob(request, thumbnail, THUMBNAIL_MIME, f"{photo_id}_{size}.{THUMBNAIL_FORMAT.lower()}")
 
 @api_router.delete("/photos/{photo_id}")
 async def delete_photo(photo_id: str, payload: dict = Depends(verify_token)):
@@ -1040,6 +2426,8 @@ async def delete_photo(photo_id: str, payload: dict = Depends(verify_token)):
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     await db.photos.delete_one({"id": photo_id})
+    for blob_id in photo_blob_ids(photo):
+        await delete_blob(blob_id)
     return {"message": "Foto eliminata"}
 
 # ============== DOCUMENTS ==============
@@ -1063,7 +2451,194 @@ async def get_documents(
     
     return docs
 
+# ============== STATISTICS ROLLUPS ==============
+# stats_monthly holds one document per (ambulatorio, tipo, YYYY-MM):
+#   accessi, prestazioni {nome: n}, pazienti {patient_id: accessi nel mese}
+# Appointment handlers keep it current with $inc; rebuild with `python server.py rebuild-stats`.
+ROLLUP_FIELDS = {"ambulatorio", "tipo", "data", "patient_id", "prestazioni"}
+ROLLUP_PROJECTION = {"_id": 0, "ambulatorio": 1, "tipo": 1, "data": 1, "ora": 1, "patient_id": 1, "prestazioni": 1}
+
+# Drop map entries that reached zero after a decrement. A month first written by an
+# appointment without prestazioni has no map yet: keep it an object, a null would make
+# the next $inc on one of its keys fail
+ROLLUP_PRUNE = [{"$set": {
+    field: {"$arrayToObject": {"$filter": {
+        "input": {"$objectToArray": {"$ifNull": [f"${field}", {}]}}, "cond": {"$gt": ["$$this.v", 0]}
+    }}}
+    for field in ("prestazioni", "pazienti")
+}}]
+
+# The ready marker is re-read periodically, so a worker notices when another one disabled the rollups
+STATS_READY_TTL = 60  # seconds
+_stats_rollups_ready = False
+_stats_rollups_checked = 0.0
+
+def enum_value(value: Any) -> Any:
+    return value.value if isinstance(value, Enum) else value
+
+def rollup_key(appointment: dict) -> Tuple[str, str, str]:
+    return enum_value(appointment["ambulatorio"]), appointment["tipo"], appointment["data"][:7]
+
+async def apply_stats_rollup(appointments: List[dict], sign: int):
+    """Add (sign=1) or remove (sign=-1) the contribution of appointments to stats_monthly"""
+    increments: Dict[Tuple[str, str, str], Dict[str, int]] = {}
+    for appointment in appointments:
+        inc = increments.setdefault(rollup_key(appointment), {})
+        fields = ["accessi", f"pazienti.{appointment['patient_id']}"]
+        fields += [f"prestazioni.{prest}" for prest in appointment.get("prestazioni") or []]
+        for field in fields:
+            inc[field] = inc.get(field, 0) + sign
+    if not increments:
+        return
+    
+    operations = []
+    for (ambulatorio, tipo, mese), inc in increments.items():
+        key = {"ambulatorio": ambulatorio, "tipo": tipo, "mese": mese}
+        operations.append(UpdateOne(key, {"$inc": inc}, upsert=True))
+        if sign < 0:
+            operations.append(UpdateOne(key, ROLLUP_PRUNE))
+    try:
+        await db.stats_monthly.bulk_write(operations)
+    except PyMongoError:
+        # The appointment write is already committed: never fail the request for the rollup.
+        # Statistics go back to the raw appointments until rebuild-stats runs
+        logger.exception("Aggiornamento rollup statistiche fallito: eseguire 'python server.py rebuild-stats'")
+        await disable_stats_rollups()
+
+async def rebuild_stats_rollups():
+    """Recompute stats_monthly from scratch, streaming appointments once.
+    Writes made while the rebuild runs may be lost: run it with the API idle"""
+    global _stats_rollups_ready, _stats_rollups_checked
+    rollups: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+    async for appointment in db.appointments.find({}, ROLLUP_PROJECTION):
+        rollup = rollups.setdefault(rollup_key(appointment), {"accessi": 0, "prestazioni": {}, "pazienti": {}})
+        rollup["accessi"] += 1
+        rollup["pazienti"][appointment["patient_id"]] = rollup["pazienti"].get(appointment["patient_id"], 0) + 1
+        for prest in appointment.get("prestazioni") or []:
+            rollup["prestazioni"][prest] = rollup["prestazioni"].get(prest, 0) + 1
+    
+    await db.stats_monthly.delete_many({})
+    if rollups:
+        await db.stats_monthly.insert_many([
+            {"ambulatorio": ambulatorio, "tipo": tipo, "mese": mese, **rollup}
+            for (ambulatorio, tipo, mese), rollup in rollups.items()
+        ])
+    await db.stats_meta.update_one(
+        {"_id": "stats_monthly"},
+        {"$set": {"built_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    _stats_rollups_ready = True
+    _stats_rollups_checked = time.monotonic()
+    logger.info(f"Rollup statistiche ricostruiti: {len(rollups)} mesi")
+    return len(rollups)
+
+async def stats_rollups_ready() -> bool:
+    """Rollups are used only once a rebuild has run; until then statistics aggregate raw appointments"""
+    global _stats_rollups_ready, _stats_rollups_checked
+    now = time.monotonic()
+    if now - _stats_rollups_checked >= STATS_READY_TTL:
+        _stats_rollups_ready = await db.stats_meta.find_one({"_id": "stats_monthly"}) is not None
+        _stats_rollups_checked = now
+    return _stats_rollups_ready
+
+async def disable_stats_rollups():
+    global _stats_rollups_ready, _stats_rollups_checked
+    _stats_rollups_ready = False
+    _stats_rollups_checked = time.monotonic()
+    try:
+        await db.stats_meta.delete_one({"_id": "stats_monthly"})
+    except PyMongoError:
+        logger.exception("Impossibile disattivare i rollup statistiche")
+
+def format_rollups(rollups: List[dict]) -> Dict[str, Any]:
+    """Merge monthly rollups (possibly several tipi per month) into the statistics response fields"""
+    total_accessi = 0
+    prestazioni_count: Dict[str, int] = {}
+    patients = set()
+    monthly_stats: Dict[str, Dict[str, Any]] = {}
+    month_patients: Dict[str, set] = {}
+    for rollup in sorted(rollups, key=lambda r: r["mese"]):
+        month = monthly_stats.setdefault(rollup["mese"], {"accessi": 0, "prestazioni": {}, "pazienti_unici": 0})
+        month["accessi"] += rollup["accessi"]
+        total_accessi += rollup["accessi"]
+        for prest, count in (rollup.get("prestazioni") or {}).items():
+            month["prestazioni"][prest] = month["prestazioni"].get(prest, 0) + count
+            prestazioni_count[prest] = prestazioni_count.get(prest, 0) + count
+        seen = {pid for pid, count in (rollup.get("pazienti") or {}).items() if count > 0}
+        month_patients.setdefault(rollup["mese"], set()).update(seen)
+        patients |= seen
+    for mese, seen in month_patients.items():
+        monthly_stats[mese]["pazienti_unici"] = len(seen)
+    # Months whose appointments were all removed leave an empty rollup behind
+    monthly_stats = {mese: m for mese, m in monthly_stats.items() if m["accessi"] > 0}
+    return {
+        "totale_accessi": total_accessi,
+        "pazienti_unici": len(patients),
+        "prestazioni": prestazioni_count,
+        "dettaglio_mensile": monthly_stats,
+    }
+
+async def rollup_statistics(ambulatorio: str, tipo: Optional[str], start_date: str, end_date: str) -> Dict[str, Any]:
+    query = {"ambulatorio": ambulatorio, "mese": {"$gte": start_date[:7], "$lt": end_date[:7]}}
+    if tipo:
+        query["tipo"] = tipo
+    rollups = await db.stats_monthly.find(query, {"_id": 0}).to_list(None)
+    return format_rollups(rollups)
+
 # ============== STATISTICS ==============
+def period_date_range(anno: int, mese: Optional[int] = None) -> Tuple[str, str]:
+    """[start, end) of a year or of a single month, as YYYY-MM-DD strings"""
+    if mese:
+        start_date = f"{anno}-{mese:02d}-01"
+        if mese == 12:
+            end_date = f"{anno + 1}-01-01"
+        else:
+            end_date = f"{anno}-{mese + 1:02d}-01"
+    else:
+        start_date = f"{anno}-01-01"
+        end_date = f"{anno + 1}-01-01"
+    return start_date, end_date
+
+def statistics_facets() -> Dict[str, List[Dict[str, Any]]]:
+    """$facet branches computing totals, prestazioni and the monthly breakdown.
+    Unique patients are counted by grouping on patient_id first, so no stage keeps
+    a per-document set in memory"""
+    month = {"$substrBytes": ["$data", 0, 7]}
+    return {
+        "totali": [
+            {"$group": {"_id": "$patient_id", "accessi": {"$sum": 1}}},
+            {"$group": {"_id": None, "accessi": {"$sum": "$accessi"}, "pazienti_unici": {"$sum": 1}}},
+        ],
+        "prestazioni": [
+            {"$unwind": "$prestazioni"},
+            {"$group": {"_id": "$prestazioni", "count": {"$sum": 1}}},
+        ],
+        "mensile": [
+            {"$group": {"_id": {"mese": month, "patient_id": "$patient_id"}, "accessi": {"$sum": 1}}},
+            {"$group": {"_id": "$_id.mese", "accessi": {"$sum": "$accessi"}, "pazienti_unici": {"$sum": 1}}},
+        ],
+        "mensile_prestazioni": [
+            {"$unwind": "$prestazioni"},
+            {"$group": {"_id": {"mese": month, "prestazione": "$prestazioni"}, "count": {"$sum": 1}}},
+        ],
+    }
+
+def format_statistics(facets: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Turn the $facet output into the totals/prestazioni/dettaglio_mensile response fields"""
+    totali = facets["totali"][0] if facets["totali"] else {"accessi": 0, "pazienti_unici": 0}
+    monthly_stats = {}
+    for row in sorted(facets["mensile"], key=lambda r: r["_id"]):
+        monthly_stats[row["_id"]] = {"accessi": row["accessi"], "prestazioni": {}, "pazienti_unici": row["pazienti_unici"]}
+    for row in facets["mensile_prestazioni"]:
+        monthly_stats[row["_id"]["mese"]]["prestazioni"][row["_id"]["prestazione"]] = row["count"]
+    return {
+        "totale_accessi": totali["accessi"],
+        "pazienti_unici": totali["pazienti_unici"],
+        "prestazioni": {row["_id"]: row["count"] for row in facets["prestazioni"]},
+        "dettaglio_mensile": monthly_stats,
+    }
+
 @api_router.get("/statistics")
 async def get_statistics(
     ambulatorio: Ambulatorio,
@@ -1079,99 +2654,147 @@ async def get_statistics(
     if ambulatorio == Ambulatorio.VILLA_GINESTRE and tipo == "MED":
         raise HTTPException(status_code=400, detail="Villa delle Ginestre non ha statistiche MED")
     
-    # Build date range
-    if mese:
-        start_date = f"{anno}-{mese:02d}-01"
-        if mese == 12:
-            end_date = f"{anno + 1}-01-01"
-        else:
-            end_date = f"{anno}-{mese + 1:02d}-01"
-    else:
-        start_date = f"{anno}-01-01"
-        end_date = f"{anno + 1}-01-01"
-    
-    query = {
-        "ambulatorio": ambulatorio.value,
-        "data": {"$gte": start_date, "$lt": end_date}
-    }
-    if tipo:
-        query["tipo"] = tipo
-    elif ambulatorio == Ambulatorio.VILLA_GINESTRE:
-        query["tipo"] = "PICC"
+    start_date, end_date = period_date_range(anno, mese)
+    tipo_filter = tipo or ("PICC" if ambulatorio == Ambulatorio.VILLA_GINESTRE else None)
     
-    appointments = await db.appointments.find(query, {"_id": 0}).to_list(10000)
-    
-    # Calculate statistics
-    total_accessi = len(appointments)
-    unique_patients = len(set(a["patient_id"] for a in appointments))
-    
-    # Prestazioni count
-    prestazioni_count = {}
-    for app in appointments:
-        for prest in app.get("prestazioni", []):
-            prestazioni_count[prest] = prestazioni_count.get(prest, 0) + 1
-    
-    # Monthly breakdown
-    monthly_stats = {}
-    for app in appointments:
-        month = app["data"][:7]  # YYYY-MM
-        if month not in monthly_stats:
-            monthly_stats[month] = {"accessi": 0, "pazienti": set(), "prestazioni": {}}
-        monthly_stats[month]["accessi"] += 1
-        monthly_stats[month]["pazienti"].add(app["patient_id"])
-        for prest in app.get("prestazioni", []):
-            monthly_stats[month]["prestazioni"][prest] = monthly_stats[month]["prestazioni"].get(prest, 0) + 1
-    
-    # Convert sets to counts
-    for month in monthly_stats:
-        monthly_stats[month]["pazienti_unici"] = len(monthly_stats[month]["pazienti"])
-        del monthly_stats[month]["pazienti"]
+    if await stats_rollups_ready():
+        stats = await rollup_statistics(ambulatorio.value, tipo_filter, start_date, end_date)
+    else:
+        query = {
+            "ambulatorio": ambulatorio.value,
+            "data": {"$gte": start_date, "$lt": end_date}
+        }
+        if tipo_filter:
+            query["tipo"] = tipo_filter
+        
+        # Single round trip, computed entirely on the server with no document cap
+        pipeline = [
+            {"$match": query},
+            {"$project": {"_id": 0, "patient_id": 1, "data": 1, "prestazioni": 1}},
+            {"$facet": statistics_facets()},
+        ]
+        facets = (await db.appointments.aggregate(pipeline, allowDiskUse=True).to_list(1))[0]
+        stats = format_statistics(facets)
     
     return {
         "anno": anno,
         "mese": mese,
         "ambulatorio": ambulatorio.value,
         "tipo": tipo,
-        "totale_accessi": total_accessi,
-        "pazienti_unici": unique_patients,
-        "prestazioni": prestazioni_count,
-        "dettaglio_mensile": monthly_stats
+        **stats
+    }
+
+MAX_COMPARE_PERIODS = 24
+
+def parse_period(period: str) -> Tuple[int, Optional[int]]:
+    """'YYYY' or 'YYYY-MM' -> (anno, mese)"""
+    try:
+        if len(period) == 4:
+            return int(period), None
+        anno, mese = period.split("-")
+        if len(anno) == 4 and 1 <= int(mese) <= 12:
+            return int(anno), int(mese)
+    except ValueError:
+        pass
+    raise HTTPException(status_code=400, detail=f"Periodo non valido: {period}")
+
+def statistics_delta(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Any]:
+    all_prestazioni = set(before["prestazioni"]) | set(after["prestazioni"])
+    return {
+        "accessi": after["totale_accessi"] - before["totale_accessi"],
+        "pazienti_unici": after["pazienti_unici"] - before["pazienti_unici"],
+        "prestazioni": {
+            prest: after["prestazioni"].get(prest, 0) - before["prestazioni"].get(prest, 0)
+            for prest in all_prestazioni
+        }
     }
 
 @api_router.get("/statistics/compare")
 async def compare_statistics(
     ambulatorio: Ambulatorio,
-    periodo1_anno: int,
+    periodi: Optional[List[str]] = Query(None),
+    periodo1_anno: Optional[int] = None,
     periodo1_mese: Optional[int] = None,
     periodo2_anno: int = None,
     periodo2_mese: Optional[int] = None,
     tipo: Optional[str] = None,
     payload: dict = Depends(verify_token)
 ):
+    """Compare any number of periods (periodi=2025&periodi=2026-03...) in one database round trip.
+    Returns per-period statistics and the deltas between consecutive periods.
+    The legacy periodo1_*/periodo2_* parameters keep their {periodo1, periodo2, differenze} response"""
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    if ambulatorio == Ambulatorio.VILLA_GINESTRE and tipo == "MED":
+        raise HTTPException(status_code=400, detail="Villa delle Ginestre non ha statistiche MED")
     
-    # Get stats for both periods
-    stats1 = await get_statistics(ambulatorio, periodo1_anno, periodo1_mese, tipo, payload)
-    stats2 = await get_statistics(ambulatorio, periodo2_anno or periodo1_anno, periodo2_mese, tipo, payload)
-    
-    # Calculate differences
-    diff = {
-        "accessi": stats2["totale_accessi"] - stats1["totale_accessi"],
-        "pazienti_unici": stats2["pazienti_unici"] - stats1["pazienti_unici"],
-        "prestazioni": {}
-    }
-    
-    all_prestazioni = set(stats1["prestazioni"].keys()) | set(stats2["prestazioni"].keys())
-    for prest in all_prestazioni:
-        val1 = stats1["prestazioni"].get(prest, 0)
-        val2 = stats2["prestazioni"].get(prest, 0)
-        diff["prestazioni"][prest] = val2 - val1
+    if periodi:
+        periods = [parse_period(p) for p in periodi]
+    elif periodo1_anno:
+        # Legacy two-period parameters
+        periods = [(periodo1_anno, periodo1_mese), (periodo2_anno or periodo1_anno, periodo2_mese)]
+    else:
+        raise HTTPException(status_code=400, detail="Specificare almeno un periodo")
+    if len(periods) > MAX_COMPARE_PERIODS:
+        raise HTTPException(status_code=400, detail=f"Massimo {MAX_COMPARE_PERIODS} periodi")
+    
+    ranges = [period_date_range(anno, mese) for anno, mese in periods]
+    tipo_filter = tipo or ("PICC" if ambulatorio == Ambulatorio.VILLA_GINESTRE else None)
+    
+    if await stats_rollups_ready():
+        # Fetch the rollups of every requested month at once, then split them per period
+        query = {
+            "ambulatorio": ambulatorio.value,
+            "$or": [{"mese": {"$gte": start[:7], "$lt": end[:7]}} for start, end in ranges]
+        }
+        if tipo_filter:
+            query["tipo"] = tipo_filter
+        rollups = await db.stats_monthly.find(query, {"_id": 0}).to_list(None)
+        results = [
+            format_rollups([r for r in rollups if start[:7] <= r["mese"] < end[:7]])
+            for start, end in ranges
+        ]
+    else:
+        # One $facet branch per (period, measure); periods may overlap
+        facets = {}
+        for i, (start, end) in enumerate(ranges):
+            for name, stages in statistics_facets().items():
+                facets[f"p{i}_{name}"] = [{"$match": {"data": {"$gte": start, "$lt": end}}}] + stages
+        query = {
+            "ambulatorio": ambulatorio.value,
+            "$or": [{"data": {"$gte": start, "$lt": end}} for start, end in ranges]
+        }
+        if tipo_filter:
+            query["tipo"] = tipo_filter
+        pipeline = [
+            {"$match": query},
+            {"$project": {"_id": 0, "patient_id": 1, "data": 1, "prestazioni": 1}},
+            {"$facet": facets},
+        ]
+        output = (await db.appointments.aggregate(pipeline, allowDiskUse=True).to_list(1))[0]
+        results = [
+            format_statistics({name: output[f"p{i}_{name}"] for name in statistics_facets()})
+            for i in range(len(ranges))
+        ]
     
+    stats = [
+        {"anno": anno, "mese": mese, "ambulatorio": ambulatorio.value, "tipo": tipo, **result}
+        for (anno, mese), result in zip(periods, results)
+    ]
+    if not periodi:
+        return {
+            "periodo1": stats[0],
+            "periodo2": stats[1],
+            "differenze": statistics_delta(stats[0], stats[1])
+        }
+    labels = [f"{anno}-{mese:02d}" if mese else str(anno) for anno, mese in periods]
+    differenze = [
+        {"da": labels[i], "a": labels[i + 1], **statistics_delta(stats[i], stats[i + 1])}
+        for i in range(len(stats) - 1)
+    ]
     return {
-        "periodo1": stats1,
-        "periodo2": stats2,
-        "differenze": diff
+        "periodi": stats,
+        "differenze": differenze
     }
 
 # ============== CALENDAR HELPERS ==============
@@ -1179,32 +2802,164 @@ async def compare_statistics(
 async def get_calendar_holidays(anno: int):
     return get_holidays(anno)
 
+def build_slot_grid(start: str, end: str, minutes: int = 30) -> List[str]:
+    slots = []
+    current = datetime.strptime(start, "%H:%M")
+    end_time = datetime.strptime(end, "%H:%M")
+    while current < end_time:
+        slots.append(current.strftime("%H:%M"))
+        current += timedelta(minutes=minutes)
+    return slots
+
+# The slot grid never changes: build it once at import
+MORNING_SLOTS = build_slot_grid("08:30", "13:00")
+AFTERNOON_SLOTS = build_slot_grid("15:00", "17:00")
+ALL_SLOTS = MORNING_SLOTS + AFTERNOON_SLOTS
+
 @api_router.get("/calendar/slots")
 async def get_time_slots():
     """Returns available time slots"""
-    morning_slots = []
-    afternoon_slots = []
-    
-    # Morning: 08:30 - 13:00
-    current = datetime.strptime("08:30", "%H:%M")
-    end_morning = datetime.strptime("13:00", "%H:%M")
-    while current < end_morning:
-        morning_slots.append(current.strftime("%H:%M"))
-        current += timedelta(minutes=30)
-    
-    # Afternoon: 15:00 - 17:00
-    current = datetime.strptime("15:00", "%H:%M")
-    end_afternoon = datetime.strptime("17:00", "%H:%M")
-    while current < end_afternoon:
-        afternoon_slots.append(current.strftime("%H:%M"))
-        current += timedelta(minutes=30)
+    return {
+        "mattina": MORNING_SLOTS,
+        "pomeriggio": AFTERNOON_SLOTS,
+        "tutti": ALL_SLOTS
+    }
+
+def holidays_between(start: date, end: date) -> set:
+    return {h for year in range(start.year, end.year + 1) for h in get_holidays(year)}
+
+def ambulatorio_tipi(ambulatorio: Ambulatorio, tipo: Optional[str] = None) -> List[str]:
+    if tipo:
+        return [tipo]
+    # Villa Ginestre only handles PICC
+    return ["PICC"] if ambulatorio == Ambulatorio.VILLA_GINESTRE else ["PICC", "MED"]
+
+def parse_date(value: str) -> date:
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Data non valida: {value}")
+
+def parse_time(value: str) -> str:
+    """HH:MM zero-padded like ALL_SLOTS, so slot times compare as strings"""
+    try:
+        return datetime.strptime(value, "%H:%M").strftime("%H:%M")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Ora non valida: {value}")
+
+# ============== AGENDA ==============
+MAX_AVAILABILITY_DAYS = 93
+
+@api_router.get("/agenda/availability")
+async def get_agenda_availability(
+    ambulatorio: Ambulatorio,
+    data_from: str,
+    data_to: str,
+    tipo: Optional[str] = None,
+    payload: dict = Depends(verify_token)
+):
+    """Every slot of every day in [data_from, data_to] with booked and remaining places"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    start, end = parse_date(data_from), parse_date(data_to)
+    n_days = (end - start).days + 1
+    if n_days < 1 or n_days > MAX_AVAILABILITY_DAYS:
+        raise HTTPException(status_code=400, detail=f"Intervallo non valido (massimo {MAX_AVAILABILITY_DAYS} giorni)")
+    
+    days = [(start + timedelta(days=i)).isoformat() for i in range(n_days)]
+    tipi = ambulatorio_tipi(ambulatorio, tipo)
+    holidays = holidays_between(start, end)
+    occupancy = await get_day_occupancy(ambulatorio.value, days)
+    
+    giorni = []
+    for i, day in enumerate(days):
+        festivo = day in holidays
+        chiuso = festivo or (start + timedelta(days=i)).weekday() >= 5
+        booked = occupancy[day]
+        slots = []
+        for ora in ALL_SLOTS:
+            slot = {"ora": ora, "tipi": {}}
+            for t in tipi:
+                prenotati = booked.get((ora, t), 0)
+                slot["tipi"][t] = {
+                    "prenotati": prenotati,
+                    "disponibili": 0 if chiuso else max(SLOT_CAPACITY - prenotati, 0)
+                }
+            slots.append(slot)
+        giorni.append({"data": day, "festivo": festivo, "chiuso": chiuso, "slots": slots})
     
     return {
-        "mattina": morning_slots,
-        "pomeriggio": afternoon_slots,
-        "tutti": morning_slots + afternoon_slots
+        "ambulatorio": ambulatorio.value,
+        "capacita": SLOT_CAPACITY,
+        "giorni": giorni
     }
 
+MAX_SEARCH_DAYS = 186
+SEARCH_CHUNK_DAYS = 31
+
+def slot_window_mask(ora_from: Optional[str], ora_to: Optional[str]) -> int:
+    """Bit i set when ALL_SLOTS[i] falls in [ora_from, ora_to)"""
+    mask = 0
+    for i, ora in enumerate(ALL_SLOTS):
+        if (not ora_from or ora >= ora_from) and (not ora_to or ora < ora_to):
+            mask |= 1 << i
+    return mask
+
+def full_slot_mask(booked: Dict[Tuple[str, str], int], tipo: str) -> int:
+    mask = 0
+    for i, ora in enumerate(ALL_SLOTS):
+        if booked.get((ora, tipo), 0) >= SLOT_CAPACITY:
+            mask |= 1 << i
+    return mask
+
+@api_router.get("/agenda/next-available")
+async def find_next_available_slots(
+    ambulatorio: Ambulatorio,
+    tipo: str,
+    data_from: str,
+    ora_from: Optional[str] = None,
+    ora_to: Optional[str] = None,
+    limit: int = Query(5, ge=1, le=50),
+    payload: dict = Depends(verify_token)
+):
+    """First free slots from data_from on, optionally within a preferred time window [ora_from, ora_to)"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    if tipo not in ambulatorio_tipi(ambulatorio):
+        raise HTTPException(status_code=400, detail="Tipo non gestito da questo ambulatorio")
+    
+    window = slot_window_mask(ora_from and parse_time(ora_from), ora_to and parse_time(ora_to))
+    start = parse_date(data_from)
+    now = datetime.now()
+    # Today only offers the slots that have not started yet
+    today, still_open = now.date().isoformat(), slot_window_mask(now.strftime("%H:%M"), None)
+    holidays = holidays_between(start, start + timedelta(days=MAX_SEARCH_DAYS))
+    
+    found = []
+    for offset in range(0, MAX_SEARCH_DAYS, SEARCH_CHUNK_DAYS):
+        # Working days only: weekends and holidays are skipped before touching the database
+        chunk = [start + timedelta(days=offset + i) for i in range(SEARCH_CHUNK_DAYS)]
+        days = [d.isoformat() for d in chunk if d.weekday() < 5 and d.isoformat() not in holidays]
+        occupancy = await get_day_occupancy(ambulatorio.value, days)
+        for day in days:
+            free = window & ~full_slot_mask(occupancy[day], tipo)
+            if day == today:
+                free &= still_open
+            while free and len(found) < limit:
+                i = (free & -free).bit_length() - 1  # lowest set bit
+                free &= free - 1
+                ora = ALL_SLOTS[i]
+                found.append({
+                    "data": day,
+                    "ora": ora,
+                    "tipo": tipo,
+                    "disponibili": SLOT_CAPACITY - occupancy[day].get((ora, tipo), 0)
+                })
+            if len(found) >= limit:
+                return {"slots": found}
+    return {"slots": found}
+
 # ============== DELETE ENDPOINTS ==============
 
 @api_router.delete("/schede-impianto-picc/{scheda_id}")
@@ -1242,16 +2997,8 @@ async def delete_scheda_medicazione(scheda_id: str, payload: dict = Depends(veri
 
 @api_router.put("/schede-impianto-picc/{scheda_id}")
 async def update_scheda_impianto(scheda_id: str, data: dict, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
     data["updated_at"] = datetime.now(timezone.utc).isoformat()
-    await db.schede_impianto_picc.update_one({"id": scheda_id}, {"$set": data})
-    updated = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
-    return updated
+    return await update_with_access(db.schede_impianto_picc, scheda_id, {"$set": data}, payload, "Scheda non trovata")
 
 # ============== IMPLANT STATISTICS ==============
 @api_router.get("/statistics/implants")
@@ -1265,49 +3012,40 @@ async def get_implant_statistics(
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    # Build date range query
-    if mese:
-        start_date = f"{anno}-{mese:02d}-01"
-        if mese == 12:
-            end_date = f"{anno + 1}-01-01"
-        else:
-            end_date = f"{anno}-{mese + 1:02d}-01"
-    else:
-        start_date = f"{anno}-01-01"
-        end_date = f"{anno + 1}-01-01"
-    
-    # Query implants
-    query = {
-        "ambulatorio": ambulatorio.value,
-        "data_impianto": {"$gte": start_date, "$lt": end_date}
-    }
-    
-    schede = await db.schede_impianto_picc.find(query, {"_id": 0}).to_list(1000)
-    
-    # Get list of existing patient IDs
-    existing_patients = await db.patients.distinct("id", {"ambulatorio": ambulatorio.value})
-    existing_patient_ids = set(existing_patients)
+    start_date, end_date = period_date_range(anno, mese)
+    tipo_catetere = {"$ifNull": ["$tipo_catetere", "altro"]}
+    pipeline = [
+        {"$match": {
+            "ambulatorio": ambulatorio.value,
+            "data_impianto": {"$gte": start_date, "$lt": end_date}
+        }},
+        {"$project": {"_id": 0, "patient_id": 1, "tipo_catetere": 1, "data_impianto": 1}},
+        # Skip schede whose patient no longer exists: one indexed probe per scheda
+        {"$lookup": {
+            "from": "patients",
+            "let": {"patient_id": "$patient_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$id", "$$patient_id"]}, "ambulatorio": ambulatorio.value}},
+                {"$project": {"_id": 0, "id": 1}},
+                {"$limit": 1},
+            ],
+            "as": "patient"
+        }},
+        {"$match": {"$or": [{"patient_id": {"$in": [None, ""]}}, {"patient.0": {"$exists": True}}]}},
+        {"$facet": {
+            "per_tipo": [{"$group": {"_id": tipo_catetere, "count": {"$sum": 1}}}],
+            "mensile": [{"$group": {
+                "_id": {"mese": {"$substrBytes": ["$data_impianto", 0, 7]}, "tipo": tipo_catetere},
+                "count": {"$sum": 1}
+            }}],
+        }},
+    ]
+    facets = (await db.schede_impianto_picc.aggregate(pipeline).to_list(1))[0]
     
-    # Count by type - only for existing patients
-    tipo_counts = {}
+    tipo_counts = {row["_id"]: row["count"] for row in facets["per_tipo"]}
     monthly_breakdown = {}
-    
-    for scheda in schede:
-        # Skip if patient no longer exists
-        patient_id = scheda.get("patient_id")
-        if patient_id and patient_id not in existing_patient_ids:
-            continue
-            
-        tipo = scheda.get("tipo_catetere", "altro")
-        tipo_counts[tipo] = tipo_counts.get(tipo, 0) + 1
-        
-        # Monthly breakdown
-        data_impianto = scheda.get("data_impianto", "")
-        if data_impianto:
-            month_key = data_impianto[:7]  # "YYYY-MM"
-            if month_key not in monthly_breakdown:
-                monthly_breakdown[month_key] = {}
-            monthly_breakdown[month_key][tipo] = monthly_breakdown[month_key].get(tipo, 0) + 1
+    for row in sorted(facets["mensile"], key=lambda r: r["_id"]["mese"]):
+        monthly_breakdown.setdefault(row["_id"]["mese"], {})[row["_id"]["tipo"]] = row["count"]
     
     # Labels for types
     tipo_labels = {
@@ -1320,7 +3058,7 @@ async def get_implant_statistics(
     }
     
     return {
-        "totale_impianti": len(schede),
+        "totale_impianti": sum(tipo_counts.values()),
         "per_tipo": tipo_counts,
         "tipo_labels": tipo_labels,
         "dettaglio_mensile": monthly_breakdown
@@ -1573,6 +3311,7 @@ async def download_patient_pdf(patient_id: str, payload: dict = Depends(verify_t
     schede_med = await db.schede_medicazione_med.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
     schede_impianto = await db.schede_impianto_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
     schede_gestione = await db.schede_gestione_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
+    schede_gestione = [decode_scheda_gestione(scheda) for scheda in schede_gestione]
     
     # NO photos passed - allegati NOT included in cartella paziente
     pdf_data = generate_patient_pdf(patient, schede_med, schede_impianto, schede_gestione, [])
@@ -1599,6 +3338,7 @@ async def download_patient_zip(patient_id: str, payload: dict = Depends(verify_t
     schede_med = await db.schede_medicazione_med.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
     schede_impianto = await db.schede_impianto_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
     schede_gestione = await db.schede_gestione_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
+    schede_gestione = [decode_scheda_gestione(scheda) for scheda in schede_gestione]
     
     zip_data = generate_patient_zip(patient, schede_med, schede_impianto, schede_gestione, [])
     
@@ -1706,6 +3446,98 @@ async def delete_prescrizione(
         raise HTTPException(status_code=404, detail="Prescrizione non trovata")
     return {"message": "Prescrizione eliminata"}
 
+# ============== DATABASE INDEXES ==============
+# One entry per query shape issued by the handlers above. Names are explicit so
+# the report can match declared indexes against what the server actually has.
+INDEX_SPECS: Dict[str, List[Dict[str, Any]]] = {
+    "patients": [
+        {"name": "id_unique", "keys": [("id", 1)], "unique": True},
+        {"name": "ambulatorio_cognome", "keys": [("ambulatorio", 1), ("cognome", 1)]},
+        {"name": "ambulatorio_status_tipo_cognome", "keys": [("ambulatorio", 1), ("status", 1), ("tipo", 1), ("cognome", 1)]},
+        {"name": "ambulatorio_search_tokens", "keys": [("ambulatorio", 1), ("search_tokens", 1)]},
+        {"name": "ambulatorio_testo", "keys": [("ambulatorio", 1), ("anamnesi", "text"), ("terapia_in_atto", "text"), ("allergie", "text")], **TEXT_INDEX_OPTIONS},
+    ],
+    "appointments": [
+        {"name": "id_unique", "keys": [("id", 1)], "unique": True},
+        {"name": "ambulatorio_data_ora_tipo", "keys": [("ambulatorio", 1), ("data", 1), ("ora", 1), ("tipo", 1)]},
+        {"name": "ambulatorio_tipo_data", "keys": [("ambulatorio", 1), ("tipo", 1), ("data", 1)]},
+        {"name": "patient_id", "keys": [("patient_id", 1)]},
+    ],
+    "schede_medicazione_med": [
+        {"name": "id_unique", "keys": [("id", 1)], "unique": True},
+        {"name": "patient_ambulatorio_data", "keys": [("patient_id", 1), ("ambulatorio", 1), ("data_compilazione", -1)]},
+        {"name": "ambulatorio_testo", "keys": [("ambulatorio", 1), ("medicazione", "text")], **TEXT_INDEX_OPTIONS},
+    ],
+    "schede_impianto_picc": [
+        {"name": "id_unique", "keys": [("id", 1)], "unique": True},
+        {"name": "patient_ambulatorio_data", "keys": [("patient_id", 1), ("ambulatorio", 1), ("data_impianto", -1)]},
+        {"name": "ambulatorio_data_impianto", "keys": [("ambulatorio", 1), ("data_impianto", 1)]},
+        {"name": "ambulatorio_testo", "keys": [("ambulatorio", 1), ("note", "text")], **TEXT_INDEX_OPTIONS},
+    ],
+    "schede_gestione_picc": [
+        {"name": "id_unique", "keys": [("id", 1)], "unique": True},
+        {"name": "patient_ambulatorio_mese_unique", "keys": [("patient_id", 1), ("ambulatorio", 1), ("mese", -1)], "unique": True},
+        {"name": "ambulatorio_testo", "keys": [("ambulatorio", 1), ("note", "text")], **TEXT_INDEX_OPTIONS},
+    ],
+    "photos": [
+        {"name": "id_unique", "keys": [("id", 1)], "unique": True},
+        {"name": "patient_ambulatorio_data_id", "keys": [("patient_id", 1), ("ambulatorio", 1), ("data", -1), ("id", -1)]},
+        {"name": "patient_ambulatorio_tipo_data_id", "keys": [("patient_id", 1), ("ambulatorio", 1), ("tipo", 1), ("data", -1), ("id", -1)]},
+    ],
+    "patient_trigrams": [
+        {"name": "ambulatorio_trigram_patient_campo_unique", "keys": [("ambulatorio", 1), ("trigram", 1), ("patient_id", 1), ("campo", 1)], "unique": True},
+        {"name": "patient_id", "keys": [("patient_id", 1)]},
+    ],
+    "slot_occupancy": [
+        {"name": "ambulatorio_data_ora_tipo_unique", "keys": [("ambulatorio", 1), ("data", 1), ("ora", 1), ("tipo", 1)], "unique": True},
+    ],
+    "stats_monthly": [
+        {"name": "ambulatorio_tipo_mese_unique", "keys": [("ambulatorio", 1), ("tipo", 1), ("mese", 1)], "unique": True},
+        {"name": "ambulatorio_mese", "keys": [("ambulatorio", 1), ("mese", 1)]},
+    ],
+    "prescrizioni": [
+        {"name": "ambulatorio", "keys": [("ambulatorio", 1)]},
+        {"name": "patient_ambulatorio", "keys": [("patient_id", 1), ("ambulatorio", 1)]},
+    ],
+}
+
+async def ensure_indexes(collections: Optional[List[str]] = None):
+    """Create every declared index. Safe to run on each startup: existing indexes are left untouched"""
+    for collection, specs in INDEX_SPECS.items():
+        if collections is not None and collection not in collections:
+            continue
+        for spec in specs:
+            options = {k: v for k, v in spec.items() if k != "keys"}
+            try:
+                await db[collection].create_index(spec["keys"], **options)
+            except OperationFailure as e:
+                # Conflicting definition or duplicate data: keep serving, the report will flag it
+                logger.warning(f"Indice {collection}.{spec['name']} non creato: {e}")
+
+async def get_index_report() -> Dict[str, Dict[str, List[str]]]:
+    """Compare declared indexes with the server: missing, never used since restart, undeclared"""
+    report = {}
+    for collection, specs in INDEX_SPECS.items():
+        declared = {spec["name"] for spec in specs}
+        existing = set(await db[collection].index_information()) - {"_id_"}
+        usage = {}
+        try:
+            async for stat in db[collection].aggregate([{"$indexStats": {}}]):
+                usage[stat["name"]] = stat["accesses"]["ops"]
+        except OperationFailure:
+            pass  # $indexStats not available (e.g. restricted user)
+        report[collection] = {
+            "missing": sorted(declared - existing),
+            "unused": sorted(name for name in declared & existing if usage.get(name) == 0),
+            "undeclared": sorted(existing - declared),
+        }
+    return report
+
+@api_router.get("/system/indexes")
+async def get_indexes_status(payload: dict = Depends(verify_token)):
+    """Index report for maintenance: usage counters reset when MongoDB restarts"""
+    return await get_index_report()
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -1724,6 +3556,39 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def startup_db():
+    await ensure_indexes()
+    # First start with slot counters: seed them from the existing appointments
+    if await db.slot_occupancy.estimated_document_count() == 0 and await db.appointments.estimated_document_count() > 0:
+        await rebuild_slot_occupancy()
+    # Patients created before the search structures existed would not be found
+    await backfill_patient_search()
+    report = await get_index_report()
+    for collection, entry in report.items():
+        if entry["missing"]:
+            logger.warning(f"Indici mancanti su {collection}: {', '.join(entry['missing'])}")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+    if _thumbnail_pool is not None:
+        _thumbnail_pool.shutdown(wait=False, cancel_futures=True)
+
+# ============== MAINTENANCE COMMANDS ==============
+# Run from the backend directory, e.g. `python server.py migrate-photos`
+MAINTENANCE_COMMANDS = {
+    "migrate-photos": migrate_inline_photos,
+    "rebuild-stats": rebuild_stats_rollups,
+    "rebuild-slots": rebuild_slot_occupancy,
+    "migrate-gestione": migrate_gestione_giorni,
+    "rebuild-search": rebuild_patient_search,
+}
+
+if __name__ == "__main__":
+    import sys
+    
+    if len(sys.argv) != 2 or sys.argv[1] not in MAINTENANCE_COMMANDS:
+        print(f"Uso: python server.py [{'|'.join(MAINTENANCE_COMMANDS)}]")
+        sys.exit(1)
+    asyncio.run(MAINTENANCE_COMMANDS[sys.argv[1]]())
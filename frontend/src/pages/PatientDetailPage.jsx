@@ -217,19 +217,15 @@ export default function PatientDetailPage() {
         requests.push(Promise.resolve({ data: [] }), Promise.resolve({ data: [] }));
       }
 
-      // Photos
-      requests.push(
-        apiClient.get("/photos", {
-          params: { patient_id: patientId, ambulatorio },
-        })
-      );
+      // Photos: metadata only, the bytes are fetched per image from /content and /thumbnail
+      requests.push(fetchPhotoMetadata(patientId, ambulatorio));
 
       const [medRes, impiantoRes, gestioneRes, photosRes] = await Promise.all(requests);
 
       setSchedeMED(medRes.data);
       setSchedeImpiantoPICC(impiantoRes.data);
       setSchedeGestionePICC(gestioneRes.data);
-      setPhotos(photosRes.data);
+      setPhotos(photosRes);
     } catch (error) {
       console.error("Error fetching medical records:", error);
     }
@@ -779,6 +775,55 @@ export default function PatientDetailPage() {
   );
 }
 
+// Every page of the attachment metadata of a patient
+async function fetchPhotoMetadata(patientId, ambulatorio) {
+  const items = [];
+  let cursor = null;
+  do {
+    const response = await apiClient.get("/photos", {
+      params: { patient_id: patientId, ambulatorio, view: "metadata", limit: 200, cursor },
+    });
+    items.push(...response.data.items);
+    cursor = response.data.next_cursor;
+  } while (cursor);
+  return items;
+}
+
+// Attachment bytes as a Blob; the endpoints need the auth header, so no plain <img src>
+async function fetchAttachmentBlob(photo) {
+  const response = await apiClient.get(`/photos/${photo.id}/content`, { responseType: "blob" });
+  return response.data;
+}
+
+// <img> for an authenticated API path, shown through an object URL;
+// fallbackPath is tried when the first one fails (e.g. no thumbnail for the format)
+function AuthImage({ path, fallbackPath, ...props }) {
+  const [url, setUrl] = useState(null);
+
+  useEffect(() => {
+    let objectUrl = null;
+    let cancelled = false;
+    apiClient
+      .get(path, { responseType: "blob" })
+      .catch((error) => {
+        if (!fallbackPath) throw error;
+        return apiClient.get(fallbackPath, { responseType: "blob" });
+      })
+      .then((response) => {
+        if (cancelled) return;
+        objectUrl = URL.createObjectURL(response.data);
+        setUrl(objectUrl);
+      })
+      .catch((error) => console.error("Error loading image:", error));
+    return () => {
+      cancelled = true;
+      if (objectUrl) URL.revokeObjectURL(objectUrl);
+    };
+  }, [path, fallbackPath]);
+
+  return url ? <img src={url} {...props} /> : <div className={`bg-muted animate-pulse ${props.className || ""}`} />;
+}
+
 // Allegati Gallery Component - Supports photos, PDF, Word, Excel
 function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefresh }) {
   const [uploading, setUploading] = useState(false);
@@ -893,18 +938,25 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
     }
   };
 
-  const handleViewDocument = (photo) => {
+  const handleViewDocument = async (photo) => {
     const fileType = photo.file_type || 'image';
     if (fileType === 'image') {
       setSelectedPhoto(photo);
     } else {
-      // For documents, open in new tab or download
-      const blob = new Blob(
-        [Uint8Array.from(atob(photo.image_data), c => c.charCodeAt(0))],
-        { type: photo.mime_type || 'application/pdf' }
-      );
-      const url = URL.createObjectURL(blob);
-      window.open(url, '_blank');
+      // For documents, open in new tab or download. The tab is opened before
+      // the fetch so popup blockers still see it as part of the click.
+      const viewWindow = window.open('', '_blank');
+      if (!viewWindow) {
+        toast.error("Consenti i popup per aprire il documento");
+        return;
+      }
+      try {
+        const blob = await fetchAttachmentBlob(photo);
+        viewWindow.location.href = URL.createObjectURL(blob);
+      } catch (error) {
+        viewWindow.close();
+        toast.error("Errore nell'apertura del documento");
+      }
     }
   };
 
@@ -1031,8 +1083,9 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                       className="aspect-square relative cursor-pointer"
                       onClick={() => setSelectedPhoto(photo)}
                     >
-                      <img
-                        src={`data:image/jpeg;base64,${photo.image_data}`}
+                      <AuthImage
+                        path={`/photos/${photo.id}/thumbnail/640`}
+                        fallbackPath={`/photos/${photo.id}/content`}
                         alt={photo.original_name || "Foto paziente"}
                         className="w-full h-full object-cover"
                       />
@@ -1047,13 +1100,19 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                           variant="outline"
                           size="sm"
                           className="flex-1 text-xs h-7"
-                          onClick={(e) => {
+                          onClick={async (e) => {
                             e.stopPropagation();
                             // Download as PDF
-                            const link = document.createElement('a');
-                            link.href = `data:image/jpeg;base64,${photo.image_data}`;
-                            link.download = `${photo.original_name || 'foto'}.jpg`;
-                            link.click();
+                            try {
+                              const url = URL.createObjectURL(await fetchAttachmentBlob(photo));
+                              const link = document.createElement('a');
+                              link.href = url;
+                              link.download = `${photo.original_name || 'foto'}.jpg`;
+                              link.click();
+                              URL.revokeObjectURL(url);
+                            } catch (error) {
+                              toast.error("Errore nel download della foto");
+                            }
                           }}
                         >
                           <Download className="w-3 h-3 mr-1" />
@@ -1063,18 +1122,27 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                           variant="outline"
                           size="sm"
                           className="flex-1 text-xs h-7"
-                          onClick={(e) => {
+                          onClick={async (e) => {
                             e.stopPropagation();
                             // Print image
                             const printWindow = window.open('', '_blank');
-                            printWindow.document.write(`
-                              <html><head><title>${photo.original_name || 'Foto'}</title></head>
-                              <body style="margin:0;display:flex;justify-content:center;align-items:center;min-height:100vh;">
-                              <img src="data:image/jpeg;base64,${photo.image_data}" style="max-width:100%;max-height:100vh;"/>
-                              </body></html>
-                            `);
-                            printWindow.document.close();
-                            printWindow.print();
+                            if (!printWindow) {
+                              toast.error("Consenti i popup per stampare la foto");
+                              return;
+                            }
+                            try {
+                              const url = URL.createObjectURL(await fetchAttachmentBlob(photo));
+                              printWindow.document.write(`
+                                <html><head><title>${photo.original_name || 'Foto'}</title></head>
+                                <body style="margin:0;display:flex;justify-content:center;align-items:center;min-height:100vh;">
+                                <img src="${url}" style="max-width:100%;max-height:100vh;" onload="window.print()"/>
+                                </body></html>
+                              `);
+                              printWindow.document.close();
+                            } catch (error) {
+                              printWindow.close();
+                              toast.error("Errore nella stampa della foto");
+                            }
                           }}
                         >
                           <Printer className="w-3 h-3 mr-1" />
@@ -1123,19 +1191,20 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                         <Button
                           variant="outline"
                           size="sm"
-                          onClick={(e) => {
+                          onClick={async (e) => {
                             e.stopPropagation();
                             // Download document
-                            const blob = new Blob(
-                              [Uint8Array.from(atob(doc.image_data), c => c.charCodeAt(0))],
-                              { type: doc.mime_type || 'application/pdf' }
-                            );
-                            const url = URL.createObjectURL(blob);
-                            const link = document.createElement('a');
-                            link.href = url;
-                            link.download = doc.original_name || 'documento';
-                            link.click();
-                            URL.revokeObjectURL(url);
+                            try {
+                              const blob = await fetchAttachmentBlob(doc);
+                              const url = URL.createObjectURL(blob);
+                              const link = document.createElement('a');
+                              link.href = url;
+                              link.download = doc.original_name || 'documento';
+                              link.click();
+                              URL.revokeObjectURL(url);
+                            } catch (error) {
+                              toast.error("Errore nel download del documento");
+                            }
                           }}
                         >
                           <Download className="w-4 h-4 mr-1" />
@@ -1144,16 +1213,28 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                         <Button
                           variant="outline"
                           size="sm"
-                          onClick={(e) => {
+                          onClick={async (e) => {
                             e.stopPropagation();
                             // Print document
-                            const blob = new Blob(
-                              [Uint8Array.from(atob(doc.image_data), c => c.charCodeAt(0))],
-                              { type: doc.mime_type || 'application/pdf' }
-                            );
-                            const url = URL.createObjectURL(blob);
-                            const printWindow = window.open(url, '_blank');
-                            printWindow.onload = () => printWindow.print();
+                            const printWindow = window.open('', '_blank');
+                            if (!printWindow) {
+                              toast.error("Consenti i popup per stampare il documento");
+                              return;
+                            }
+                            try {
+                              const blob = await fetchAttachmentBlob(doc);
+                              const url = URL.createObjectURL(blob);
+                              printWindow.document.write(`
+                                <html><head><title>${doc.original_name || 'Documento'}</title></head>
+                                <body style="margin:0;">
+                                <iframe src="${url}" style="border:0;width:100%;height:100vh;" onload="this.contentWindow.print()"></iframe>
+                                </body></html>
+                              `);
+                              printWindow.document.close();
+                            } catch (error) {
+                              printWindow.close();
+                              toast.error("Errore nella stampa del documento");
+                            }
                           }}
                         >
                           <Printer className="w-4 h-4 mr-1" />
@@ -1242,8 +1323,8 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                 className="overflow-auto rounded-lg border bg-muted/30" 
                 style={{ maxHeight: '60vh', maxWidth: '100%' }}
               >
-                <img
-                  src={`data:image/jpeg;base64,${selectedPhoto.image_data}`}
+                <AuthImage
+                  path={`/photos/${selectedPhoto.id}/content`}
                   alt="Foto ingrandita"
                   className="transition-transform duration-200"
                   style={{ 
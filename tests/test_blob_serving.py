@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from server import parse_range, serve_blob
+
+CONTENTS = b"0123456789"
+BLOB = {"size": len(CONTENTS), "sha256": hashlib.sha256(CONTENTS).hexdigest()}
+ETAG = f'"{BLOB["sha256"]}"'
+
+
+def make_request(**headers):
+    raw = [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw})
+
+
+def body(response):
+    async def collect():
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-3", (0, 3)),
+    ("bytes=5-", (5, 9)),
+    ("bytes=-4", (6, 9)),
+    ("bytes=-40", (0, 9)),
+    ("bytes=8-100", (8, 9)),
+    ("bytes=0-1,4-5", None),
+    ("items=0-1", None),
+    ("bytes=a-b", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 10) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=10-", "bytes=5-2"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(HTTPException) as excinfo:
+        parse_range(header, 10)
+    assert excinfo.value.status_code == 416
+    assert excinfo.value.headers["Content-Range"] == "bytes */10"
+
+
+def test_serve_blob_full():
+    response = serve_blob(make_request(), BLOB, "image/jpeg", "foto.jpg", CONTENTS)
+    assert response.status_code == 200
+    assert response.headers["etag"] == ETAG
+    assert response.headers["content-length"] == "10"
+    assert body(response) == CONTENTS
+
+
+def test_serve_blob_not_modified():
+    response = serve_blob(make_request(if_none_match=f'"other", {ETAG}'), BLOB, "image/jpeg", "foto.jpg", CONTENTS)
+    assert response.status_code == 304
+
+
+def test_serve_blob_partial():
+    response = serve_blob(make_request(range="bytes=2-5"), BLOB, "image/jpeg", "foto.jpg", CONTENTS)
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 2-5/10"
+    assert response.headers["content-length"] == "4"
+    assert body(response) == b"2345"
+
+
+def test_serve_blob_if_range_mismatch_sends_everything():
+    request = make_request(range="bytes=2-5", if_range='"stale"')
+    response = serve_blob(request, BLOB, "image/jpeg", "foto.jpg", CONTENTS)
+    assert response.status_code == 200
+    assert body(response) == CONTENTS
+
+
+def test_serve_blob_unsatisfiable_range():
+    with pytest.raises(HTTPException) as excinfo:
+        serve_blob(make_request(range="bytes=20-"), BLOB, "image/jpeg", "foto.jpg", CONTENTS)
+    assert excinfo.value.status_code == 416
@@ -0,0 +1,27 @@
+import pytest
+from bson import Int64
+
+from server import GESTIONE_FLAG_BITS, decode_gestione_day, encode_gestione_day
+
+
+@pytest.mark.parametrize("day", [
+    {},
+    {"lavaggio_mani": "Sì", "febbre": "No", "port_protector": "X"},
+    {"lavaggio_mani": "", "ispezione_sito": "si", "emocoltura": "3 ml"},
+    {"note": "libero", "firma": "MR", "sito_dolente": "No"},
+])
+def test_day_round_trip_is_lossless(day):
+    assert decode_gestione_day(encode_gestione_day(day)) == day
+
+
+def test_grid_answers_go_into_bitmasks():
+    packed = encode_gestione_day({"lavaggio_mani": "Sì", "febbre": "No", "port_protector": "X", "firma": "MR"})
+    assert packed["s"] == GESTIONE_FLAG_BITS["lavaggio_mani"]
+    assert packed["n"] == GESTIONE_FLAG_BITS["febbre"]
+    assert packed["x"] == GESTIONE_FLAG_BITS["port_protector"]
+    assert packed["v"] == {"firma": "MR"}
+    assert all(isinstance(packed[key], Int64) for key in ("s", "n", "x"))
+
+
+def test_legacy_unpacked_day_decodes_as_is():
+    assert decode_gestione_day({"lavaggio_mani": "Sì", "note": "x"}) == {"lavaggio_mani": "Sì", "note": "x"}
@@ -0,0 +1,51 @@
+import pytest
+from bson import Int64
+from fastapi import HTTPException
+
+from server import GESTIONE_FLAG_BITS, GestioneCellUpdate, gestione_patch_update
+
+
+def change(giorno, campo=None, valore=None):
+    return GestioneCellUpdate(giorno=giorno, campo=campo, valore=valore)
+
+
+def test_patch_flag_cell_sets_its_bit_and_clears_the_others():
+    bit = GESTIONE_FLAG_BITS["febbre"]
+    update = gestione_patch_update([change("5", "febbre", "No")])
+    assert update["$bit"]["giorni.5.n"] == {"and": Int64(~bit), "or": Int64(bit)}
+    assert update["$bit"]["giorni.5.s"] == {"and": Int64(~bit), "or": Int64(0)}
+    assert update["$bit"]["giorni.5.x"] == {"and": Int64(~bit), "or": Int64(0)}
+    assert update["$unset"] == {"giorni.5.febbre": "", "giorni.5.v.febbre": ""}
+    assert update["$set"] == {}
+
+
+def test_patch_free_text_goes_to_v():
+    update = gestione_patch_update([change("5", "febbre", "38.2")])
+    assert update["$set"] == {"giorni.5.v.febbre": "38.2"}
+    assert update["$bit"]["giorni.5.s"]["or"] == 0
+
+
+def test_patch_whole_day_is_encoded():
+    update = gestione_patch_update([change("7", valore={"lavaggio_mani": "Sì"})])
+    assert update["$set"] == {"giorni.7": {"s": Int64(GESTIONE_FLAG_BITS["lavaggio_mani"])}}
+    assert gestione_patch_update([change("7")])["$unset"] == {"giorni.7": ""}
+
+
+def test_patch_later_change_of_the_same_cell_wins():
+    update = gestione_patch_update([change("5", "note", "a"), change("5", "note", "b")])
+    assert update["$set"] == {"giorni.5.v.note": "b"}
+
+
+@pytest.mark.parametrize("modifiche", [
+    [change("5", valore={}), change("5", "febbre", "Sì")],
+    [change("5", "s", "x")],
+    [change("5", "v", "x")],
+    [change("5", "x", "x"), change("5", "port_protector", "X")],
+    [change("5.1", "febbre", "Sì")],
+    [change("5", "$set", "x")],
+    [change("5", valore={}), change("5-1", "note", "a"), change("5", "note", "b")],
+])
+def test_patch_rejects_invalid_or_conflicting_changes(modifiche):
+    with pytest.raises(HTTPException) as excinfo:
+        gestione_patch_update(modifiche)
+    assert excinfo.value.status_code == 400
@@ -0,0 +1,31 @@
+import pytest
+from fastapi import HTTPException
+
+from server import SUMMARY_FIELDS, Appointment, Patient, list_projection
+
+
+@pytest.mark.parametrize("view", [None, "full"])
+def test_full_view_has_no_projection(view):
+    assert list_projection(Patient, None, view) is None
+
+
+def test_summary_view_projects_summary_fields():
+    projection = list_projection(Appointment, None, "summary")
+    assert projection == {"_id": 0, "id": 1, **{name: 1 for name in SUMMARY_FIELDS[Appointment]}}
+
+
+def test_fields_override_the_view():
+    assert list_projection(Patient, " nome, cognome ,", "summary") == {"_id": 0, "id": 1, "nome": 1, "cognome": 1}
+
+
+def test_unknown_field_is_a_bad_request():
+    with pytest.raises(HTTPException) as excinfo:
+        list_projection(Patient, "nome,password", None)
+    assert excinfo.value.status_code == 400
+    assert "password" in excinfo.value.detail
+
+
+def test_unknown_view_is_a_bad_request():
+    with pytest.raises(HTTPException) as excinfo:
+        list_projection(Patient, None, "compact")
+    assert excinfo.value.status_code == 400
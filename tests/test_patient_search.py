@@ -0,0 +1,40 @@
+from server import fuzzy_score, name_trigrams, patient_search_tokens, patient_trigrams
+
+
+def score(query, patient):
+    """Score a patient the way the fuzzy search pipeline does, from its postings"""
+    grams = name_trigrams(query)
+    fields = {field: set(postings) for field, postings in patient_trigrams(patient).items()}
+    hits = len(grams & set().union(*fields.values()))
+    return fuzzy_score(len(grams), hits, [{"hits": len(grams & f), "n": len(f)} for f in fields.values()])
+
+
+def test_query_and_names_are_tokenized_alike():
+    assert name_trigrams("Di Stefano") == name_trigrams("Distefano")
+    assert set(patient_trigrams({"nome": "Giuseppe", "cognome": "Di Stefano"})["cognome"]) == name_trigrams("distefano")
+
+
+def test_spacing_variants_match_fully():
+    patient = {"nome": "Giuseppe Maria", "cognome": "Distefano"}
+    assert score("Di Stefano", patient) == (1.0, 1.0)
+    assert score("Di Stefano", {"nome": "Giuseppe", "cognome": "Di Stefano"}) == (1.0, 1.0)
+
+
+def test_surname_only_is_not_diluted_by_first_name():
+    containment, _ = score("Rossi", {"nome": "Massimiliano Giovanni", "cognome": "Rossi"})
+    assert containment == 1.0
+
+
+def test_typo_scores_below_exact_match():
+    patient = {"nome": "Mario", "cognome": "Rossi"}
+    typo, exact = score("Rosi", patient), score("Rossi", patient)
+    assert 0.5 <= typo[0] < exact[0]
+
+
+def test_unrelated_name_does_not_match():
+    assert score("Bianchi", {"nome": "Mario", "cognome": "Rossi"})[0] < 0.5
+
+
+def test_search_tokens_are_accent_insensitive():
+    tokens = patient_search_tokens({"nome": "Niccolò", "cognome": "D'Amico", "codice_fiscale": None})
+    assert "niccolo" in tokens
@@ -0,0 +1,21 @@
+import pytest
+from fastapi import HTTPException
+
+from server import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    values = {"data": "2026-03-01T10:00:00", "id": "abc"}
+    assert decode_cursor(encode_cursor(values), ("data", "id")) == values
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    encode_cursor(["data", "id"]),
+    encode_cursor({"data": "2026-03-01"}),
+    "bm90IGpzb24=",  # "not json"
+])
+def test_invalid_cursor_is_a_bad_request(cursor):
+    with pytest.raises(HTTPException) as excinfo:
+        decode_cursor(cursor, ("data", "id"))
+    assert excinfo.value.status_code == 400
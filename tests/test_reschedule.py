@@ -0,0 +1,36 @@
+from server import ALL_SLOTS, SLOT_CAPACITY, plan_reschedule
+
+
+def appointment(id, ora, tipo="PICC"):
+    return {"id": id, "data": "2026-03-02", "ora": ora, "tipo": tipo, "patient_nome": "Mario", "patient_cognome": "Rossi"}
+
+
+def test_keeps_the_time_on_the_first_free_day():
+    booked = {("2026-03-03", "09:00", "PICC"): SLOT_CAPACITY}
+    plan, non_spostati = plan_reschedule([appointment("a", "09:00")], ["2026-03-03", "2026-03-04"], booked, True)
+    assert [(moved["data"], moved["ora"]) for _, moved in plan] == [("2026-03-04", "09:00")]
+    assert non_spostati == []
+
+
+def test_counts_the_places_taken_by_the_plan():
+    appointments = [appointment(str(i), "09:00") for i in range(SLOT_CAPACITY + 1)]
+    booked = {}
+    plan, non_spostati = plan_reschedule(appointments, ["2026-03-03"], booked, True)
+    assert len(plan) == SLOT_CAPACITY
+    assert [entry["id"] for entry in non_spostati] == [str(SLOT_CAPACITY)]
+    assert booked == {("2026-03-03", "09:00", "PICC"): SLOT_CAPACITY}
+
+
+def test_falls_back_to_another_time_unless_restricted():
+    booked = {("2026-03-03", "09:00", "PICC"): SLOT_CAPACITY}
+    plan, _ = plan_reschedule([appointment("a", "09:00")], ["2026-03-03"], dict(booked), False)
+    assert plan[0][1]["ora"] == next(ora for ora in ALL_SLOTS if ora != "09:00")
+    plan, non_spostati = plan_reschedule([appointment("a", "09:00")], ["2026-03-03"], dict(booked), True)
+    assert plan == [] and non_spostati[0]["motivo"] == "Nessuno slot libero"
+
+
+def test_slots_are_per_tipo():
+    booked = {("2026-03-03", "09:00", "PICC"): SLOT_CAPACITY}
+    plan, _ = plan_reschedule([appointment("a", "09:00", "MED")], ["2026-03-03"], booked, True)
+    assert (plan[0][1]["data"], plan[0][1]["ora"]) == ("2026-03-03", "09:00")
+    assert plan[0][0]["data"] == "2026-03-02"
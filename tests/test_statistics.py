@@ -0,0 +1,156 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import Ambulatorio, format_rollups, format_statistics, parse_period, period_date_range, statistics_delta
+
+
+def facets(totali=(), prestazioni=(), mensile=(), mensile_prestazioni=()):
+    return {
+        "totali": list(totali),
+        "prestazioni": list(prestazioni),
+        "mensile": list(mensile),
+        "mensile_prestazioni": list(mensile_prestazioni),
+    }
+
+
+def test_format_statistics():
+    stats = format_statistics(facets(
+        totali=[{"_id": None, "accessi": 5, "pazienti_unici": 3}],
+        prestazioni=[{"_id": "medicazione_semplice", "count": 4}, {"_id": "fasciatura_semplice", "count": 1}],
+        mensile=[
+            {"_id": "2026-02", "accessi": 2, "pazienti_unici": 2},
+            {"_id": "2026-01", "accessi": 3, "pazienti_unici": 2},
+        ],
+        mensile_prestazioni=[
+            {"_id": {"mese": "2026-01", "prestazione": "medicazione_semplice"}, "count": 3},
+            {"_id": {"mese": "2026-02", "prestazione": "medicazione_semplice"}, "count": 1},
+            {"_id": {"mese": "2026-02", "prestazione": "fasciatura_semplice"}, "count": 1},
+        ],
+    ))
+    assert stats == {
+        "totale_accessi": 5,
+        "pazienti_unici": 3,
+        "prestazioni": {"medicazione_semplice": 4, "fasciatura_semplice": 1},
+        "dettaglio_mensile": {
+            "2026-01": {"accessi": 3, "prestazioni": {"medicazione_semplice": 3}, "pazienti_unici": 2},
+            "2026-02": {"accessi": 2, "prestazioni": {"medicazione_semplice": 1, "fasciatura_semplice": 1}, "pazienti_unici": 2},
+        },
+    }
+    assert list(stats["dettaglio_mensile"]) == ["2026-01", "2026-02"]
+
+
+def test_format_statistics_without_appointments():
+    assert format_statistics(facets()) == {
+        "totale_accessi": 0,
+        "pazienti_unici": 0,
+        "prestazioni": {},
+        "dettaglio_mensile": {},
+    }
+
+
+def test_format_rollups_merges_tipi_per_month():
+    stats = format_rollups([
+        {"mese": "2026-02", "tipo": "MED", "accessi": 1, "prestazioni": {"medicazione_semplice": 1}, "pazienti": {"p1": 1}},
+        {"mese": "2026-01", "tipo": "MED", "accessi": 2, "prestazioni": {"medicazione_semplice": 2}, "pazienti": {"p1": 2}},
+        {"mese": "2026-01", "tipo": "PICC", "accessi": 1, "prestazioni": {"medicazione_semplice": 1}, "pazienti": {"p1": 1, "p2": 0}},
+    ])
+    assert stats == {
+        "totale_accessi": 4,
+        "pazienti_unici": 1,
+        "prestazioni": {"medicazione_semplice": 4},
+        "dettaglio_mensile": {
+            "2026-01": {"accessi": 3, "prestazioni": {"medicazione_semplice": 3}, "pazienti_unici": 1},
+            "2026-02": {"accessi": 1, "prestazioni": {"medicazione_semplice": 1}, "pazienti_unici": 1},
+        },
+    }
+
+
+def test_format_rollups_drops_emptied_months():
+    stats = format_rollups([
+        {"mese": "2026-01", "tipo": "MED", "accessi": 0, "prestazioni": {}, "pazienti": {}},
+        {"mese": "2026-02", "tipo": "MED", "accessi": 1, "pazienti": {"p1": 1}},
+    ])
+    assert list(stats["dettaglio_mensile"]) == ["2026-02"]
+    assert stats["totale_accessi"] == 1 and stats["prestazioni"] == {}
+
+
+@pytest.mark.parametrize("anno, mese, expected", [
+    (2026, None, ("2026-01-01", "2027-01-01")),
+    (2026, 3, ("2026-03-01", "2026-04-01")),
+    (2026, 12, ("2026-12-01", "2027-01-01")),
+])
+def test_period_date_range(anno, mese, expected):
+    assert period_date_range(anno, mese) == expected
+
+
+@pytest.mark.parametrize("period, expected", [
+    ("2026", (2026, None)),
+    ("2026-03", (2026, 3)),
+    ("2026-3", (2026, 3)),
+    ("2026-12", (2026, 12)),
+])
+def test_parse_period(period, expected):
+    assert parse_period(period) == expected
+
+
+@pytest.mark.parametrize("period", ["", "26", "anno", "2026-00", "2026-13", "2026-xx", "26-03", "2026-03-01"])
+def test_invalid_period_is_a_bad_request(period):
+    with pytest.raises(HTTPException) as excinfo:
+        parse_period(period)
+    assert excinfo.value.status_code == 400
+
+
+def test_statistics_delta_covers_prestazioni_of_either_period():
+    before = {"totale_accessi": 4, "pazienti_unici": 2, "prestazioni": {"medicazione_semplice": 3, "rimozione_punti": 1}}
+    after = {"totale_accessi": 6, "pazienti_unici": 1, "prestazioni": {"medicazione_semplice": 5, "fasciatura_semplice": 1}}
+    assert statistics_delta(before, after) == {
+        "accessi": 2,
+        "pazienti_unici": -1,
+        "prestazioni": {"medicazione_semplice": 2, "rimozione_punti": -1, "fasciatura_semplice": 1},
+    }
+
+
+class FakeRollups:
+    def __init__(self, rollups):
+        self.rollups = rollups
+
+    def find(self, query, projection):
+        return self
+
+    async def to_list(self, length):
+        return self.rollups
+
+
+def compare(monkeypatch, **params):
+    async def ready():
+        return True
+    rollups = [
+        {"mese": "2025-03", "tipo": "MED", "accessi": 2, "prestazioni": {"medicazione_semplice": 2}, "pazienti": {"p1": 2}},
+        {"mese": "2026-03", "tipo": "MED", "accessi": 3, "prestazioni": {"medicazione_semplice": 1}, "pazienti": {"p1": 1, "p2": 2}},
+    ]
+    monkeypatch.setattr(server, "stats_rollups_ready", ready)
+    monkeypatch.setattr(server, "db", SimpleNamespace(stats_monthly=FakeRollups(rollups)))
+    defaults = dict(periodi=None, periodo1_anno=None, periodo1_mese=None, periodo2_anno=None, periodo2_mese=None, tipo=None)
+    return asyncio.run(server.compare_statistics(
+        ambulatorio=Ambulatorio.PTA_CENTRO, payload={"ambulatori": ["pta_centro"]}, **{**defaults, **params}
+    ))
+
+
+def test_compare_keeps_the_legacy_two_period_shape(monkeypatch):
+    result = compare(monkeypatch, periodo1_anno=2025, periodo1_mese=3, periodo2_anno=2026, periodo2_mese=3)
+    assert set(result) == {"periodo1", "periodo2", "differenze"}
+    assert (result["periodo1"]["anno"], result["periodo1"]["mese"], result["periodo1"]["totale_accessi"]) == (2025, 3, 2)
+    assert (result["periodo2"]["anno"], result["periodo2"]["mese"], result["periodo2"]["totale_accessi"]) == (2026, 3, 3)
+    assert result["differenze"] == {"accessi": 1, "pazienti_unici": 1, "prestazioni": {"medicazione_semplice": -1}}
+
+
+def test_compare_periodi_lists_consecutive_deltas(monkeypatch):
+    result = compare(monkeypatch, periodi=["2025-03", "2026-03"])
+    assert [p["totale_accessi"] for p in result["periodi"]] == [2, 3]
+    assert result["differenze"] == [
+        {"da": "2025-03", "a": "2026-03", "accessi": 1, "pazienti_unici": 1, "prestazioni": {"medicazione_semplice": -1}}
+    ]